@@ -0,0 +1,214 @@
+"""
+    本地假 ComfyUI，用于压测 balancer 和 service
+    实现 /prompt、/history、/queue、/system_stats、/view、/interrupt 和 /ws，
+    执行耗时、并发数、失败率可配置，执行过程按真实 ComfyUI 的顺序推送 websocket 事件
+
+    python fake_comfyui.py --port 8000 --latency 2 --jitter 0.5 --workers 1
+"""
+import argparse
+import asyncio
+import random
+import struct
+import time
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional, Set
+
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response
+
+
+def make_png(width: int, height: int, seed: int) -> bytes:
+    """生成一张灰度渐变 PNG，不依赖 Pillow"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    rows = b"".join(b"\x00" + bytes((x + y + seed) & 0xff for x in range(width)) for y in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 6)) + chunk(b"IEND", b"")
+
+
+class FakeComfy:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pending: Dict[str, List[Any]] = {}
+        self.running: Dict[str, List[Any]] = {}
+        self.history: Dict[str, Dict[str, Any]] = {}
+        self.sockets: Dict[str, Set[WebSocket]] = {}
+        self.number = 0
+        self.image_counter = 0
+        self.image = make_png(args.image_size, args.image_size, 0)
+
+    async def send(self, client_id: str, event: str, data: Dict[str, Any]):
+        for ws in list(self.sockets.get(client_id, ())):
+            try:
+                await ws.send_json({"type": event, "data": data})
+            except Exception:
+                self.sockets.get(client_id, set()).discard(ws)
+
+    def submit(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+        self.number += 1
+        item = [self.number, prompt_id, body["prompt"], body.get("extra_data", {}), [], body.get("client_id", "")]
+        self.pending[prompt_id] = item
+        self.queue.put_nowait(item)
+        return {"prompt_id": prompt_id, "number": self.number, "node_errors": {}}
+
+    async def execute(self, item: List[Any]):
+        number, prompt_id, prompt, _, _, client_id = item
+        self.pending.pop(prompt_id, None)
+        self.running[prompt_id] = item
+        started = time.time()
+        duration = max(0.0, random.gauss(self.args.latency, self.args.jitter))
+        node_ids = list(prompt) or ["1"]
+        await self.send(client_id, "execution_start", {"prompt_id": prompt_id, "timestamp": int(started * 1000)})
+        await self.send(client_id, "execution_cached", {"nodes": [], "prompt_id": prompt_id})
+        sampler = node_ids[len(node_ids) // 2]
+        await self.send(client_id, "executing", {"node": sampler, "display_node": sampler, "prompt_id": prompt_id})
+        steps = max(1, self.args.steps)
+        for step in range(1, steps + 1):
+            await asyncio.sleep(duration / steps)
+            await self.send(client_id, "progress", {"value": step, "max": steps, "prompt_id": prompt_id,
+                                                    "node": sampler})
+
+        failed = random.random() < self.args.error_rate
+        outputs: Dict[str, Any] = {}
+        if failed:
+            await self.send(client_id, "execution_error", {"prompt_id": prompt_id, "node_id": sampler,
+                                                           "exception_message": "fake failure"})
+        else:
+            images = []
+            # 与真实 ComfyUI 一样，每张 batch_size 输出一张图片
+            batch_size = max([node.get("inputs", {}).get("batch_size", 1) for node in prompt.values()
+                              if isinstance(node.get("inputs", {}).get("batch_size", 1), int)] or [1])
+            for _ in range(self.args.images * batch_size):
+                self.image_counter += 1
+                images.append({"filename": f"ComfyUI_{self.image_counter:05}_.png", "subfolder": "", "type": "output"})
+            output_node = node_ids[-1]
+            outputs[output_node] = {"images": images}
+            await self.send(client_id, "executed", {"node": output_node, "display_node": output_node,
+                                                    "output": {"images": images}, "prompt_id": prompt_id})
+            await self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+            await self.send(client_id, "execution_success", {"prompt_id": prompt_id,
+                                                             "timestamp": int(time.time() * 1000)})
+        self.running.pop(prompt_id, None)
+        self.history[prompt_id] = {
+            "prompt": item,
+            "outputs": outputs,
+            "status": {"status_str": "error" if failed else "success", "completed": not failed, "messages": []},
+        }
+        while len(self.history) > self.args.history_size:
+            self.history.pop(next(iter(self.history)))
+
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.execute(item)
+            except Exception as e:
+                print(f"fake comfy worker error: {e}")
+
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    app = FastAPI(title="Fake ComfyUI")
+    comfy = FakeComfy(args)
+
+    @app.on_event("startup")
+    async def startup():
+        for _ in range(args.workers):
+            asyncio.create_task(comfy.worker())
+
+    async def delay():
+        if args.api_latency:
+            await asyncio.sleep(args.api_latency)
+
+    @app.post("/prompt")
+    async def prompt(request: Request):
+        await delay()
+        body = await request.json()
+        if not isinstance(body.get("prompt"), dict):
+            return JSONResponse({"error": {"type": "invalid_prompt", "message": "prompt must be an object"},
+                                 "node_errors": {}}, status_code=400)
+        if args.max_queue and len(comfy.pending) >= args.max_queue:
+            return JSONResponse({"error": "queue is full"}, status_code=503)
+        return comfy.submit(body)
+
+    @app.get("/queue")
+    async def queue():
+        await delay()
+        return {"queue_running": list(comfy.running.values()), "queue_pending": list(comfy.pending.values())}
+
+    @app.get("/history")
+    async def history(max_items: Optional[int] = None):
+        await delay()
+        items = list(comfy.history.items())
+        if max_items:
+            items = items[-max_items:]
+        return dict(items)
+
+    @app.get("/history/{prompt_id}")
+    async def history_item(prompt_id: str):
+        await delay()
+        return {prompt_id: comfy.history[prompt_id]} if prompt_id in comfy.history else {}
+
+    @app.get("/system_stats")
+    async def system_stats():
+        await delay()
+        vram_total = 24 * 1024 ** 3
+        vram_free = vram_total - (len(comfy.running) * 6 * 1024 ** 3)
+        return {
+            "system": {"os": "fake", "python_version": "3.11", "comfyui_version": "fake"},
+            "devices": [{"name": "fake:0", "type": "cuda", "index": 0, "vram_total": vram_total,
+                         "vram_free": vram_free, "torch_vram_total": vram_total, "torch_vram_free": vram_free}],
+        }
+
+    @app.get("/view")
+    async def view(filename: str, subfolder: str = "", type: str = "output"):
+        await delay()
+        return Response(comfy.image, media_type="image/png",
+                        headers={"Content-Disposition": f'filename="{filename}"'})
+
+    @app.api_route("/interrupt", methods=["GET", "POST"])
+    async def interrupt():
+        return {}
+
+    @app.websocket("/ws")
+    async def ws(websocket: WebSocket, clientId: str = ""):
+        await websocket.accept()
+        client_id = clientId or uuid.uuid4().hex
+        comfy.sockets.setdefault(client_id, set()).add(websocket)
+        await websocket.send_json({"type": "status", "data": {"status": {"exec_info": {
+            "queue_remaining": len(comfy.pending) + len(comfy.running)}}, "sid": client_id}})
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            comfy.sockets.get(client_id, set()).discard(websocket)
+
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake ComfyUI for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=2.0, help="平均执行耗时(秒)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="执行耗时标准差(秒)")
+    parser.add_argument("--steps", type=int, default=10, help="每个任务推送的 progress 事件数")
+    parser.add_argument("--workers", type=int, default=1, help="同时执行的任务数，真实 ComfyUI 为 1")
+    parser.add_argument("--max-queue", type=int, default=0, help="排队上限，超过返回 503，0 为不限制")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="执行失败的概率")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="HTTP 接口附加延迟(秒)")
+    parser.add_argument("--images", type=int, default=1, help="每个任务输出的图片数")
+    parser.add_argument("--image-size", type=int, default=512, help="输出图片边长(像素)")
+    parser.add_argument("--history-size", type=int, default=10000)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
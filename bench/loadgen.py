@@ -0,0 +1,189 @@
+"""
+    回放 JSONL 生成请求的压测客户端
+    按目标 RPS 向 balancer 提交 /api/generate，用长轮询等待任务结束，
+    最后输出吞吐、提交与端到端延迟分位数、错误分布，以及(对比 /metrics 前后)各节点分发数
+
+    python loadgen.py --url http://127.0.0.1:7999 --requests requests.sample.jsonl --rps 5 --duration 60
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+import httpx
+
+DISPATCH_PATTERN = re.compile(r'^comfy_balancer_dispatch_total\{node="([^"]+)",outcome="accepted"\} ([0-9.e+]+)$')
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Result:
+    def __init__(self):
+        self.submitted = 0
+        self.submit_latency: List[float] = []
+        self.e2e_latency: List[float] = []
+        self.outcomes: Counter = Counter()
+
+    def summary(self, elapsed: float, dispatch: Dict[str, float]) -> Dict[str, Any]:
+        completed = self.outcomes.get("success", 0)
+
+        def stats(values: List[float]) -> Dict[str, float]:
+            return {f"p{p}": round(percentile(values, p) * 1000, 1) for p in (50, 90, 99)} | \
+                {"max": round(max(values, default=0) * 1000, 1)}
+
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "submitted": self.submitted,
+            "completed": completed,
+            "throughput_rps": round(completed / elapsed, 3) if elapsed else 0,
+            "submit_latency_ms": stats(self.submit_latency),
+            "e2e_latency_ms": stats(self.e2e_latency),
+            "outcomes": dict(self.outcomes),
+            "per_node": dispatch,
+        }
+
+
+async def scrape_dispatch(client: httpx.AsyncClient) -> Dict[str, float]:
+    """读取 balancer /metrics 中各节点被接受的分发数"""
+    try:
+        response = await client.get("/metrics")
+    except httpx.HTTPError:
+        return {}
+    counts = {}
+    for line in response.text.splitlines():
+        match = DISPATCH_PATTERN.match(line)
+        if match:
+            counts[match.group(1)] = float(match.group(2))
+    return counts
+
+
+async def run_one(client: httpx.AsyncClient, body: Dict[str, Any], result: Result, args: argparse.Namespace):
+    start = time.perf_counter()
+    try:
+        response = await client.post("/api/generate", json=body, timeout=args.timeout)
+    except httpx.HTTPError as e:
+        result.outcomes[f"submit:{type(e).__name__}"] += 1
+        return
+    result.submit_latency.append(time.perf_counter() - start)
+    if response.status_code != 200:
+        result.outcomes[f"submit:{response.status_code}"] += 1
+        return
+    data = response.json()
+    if data.get("cached"):
+        result.outcomes["cached"] += 1
+        return
+    task_id = data["task_id"]
+    deadline = start + args.timeout
+    while time.perf_counter() < deadline:
+        wait = max(1, min(30, int(deadline - time.perf_counter())))
+        try:
+            status = await client.get(f"/api/task/{task_id}", params={"wait": wait}, timeout=wait + 10)
+        except httpx.HTTPError as e:
+            result.outcomes[f"status:{type(e).__name__}"] += 1
+            return
+        if status.status_code != 200:
+            result.outcomes[f"status:{status.status_code}"] += 1
+            return
+        state = status.json().get("status")
+        if state in ("success", "error"):
+            result.e2e_latency.append(time.perf_counter() - start)
+            result.outcomes[state] += 1
+            return
+    result.outcomes["timeout"] += 1
+
+
+def load_requests(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def prepare(body: Dict[str, Any], args: argparse.Namespace) -> Dict[str, Any]:
+    body = dict(body)
+    if args.no_cache:
+        body["cache"] = False
+    if args.random_seed:
+        body["inputs"] = {**(body.get("inputs") or {}), "seed": random.randint(0, 2 ** 32 - 1)}
+    return body
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    bodies = load_requests(args.requests)
+    result = Result()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits) as client:
+        before = await scrape_dispatch(client)
+        tasks = set()
+        interval = 1 / args.rps
+        start = time.perf_counter()
+        source = itertools.cycle(bodies) if args.count == 0 else itertools.islice(itertools.cycle(bodies), args.count)
+        for n, body in enumerate(source):
+            # 按固定节拍发送(开环)，慢响应不会降低发送速率
+            scheduled = start + n * interval
+            if args.count == 0 and scheduled - start >= args.duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            result.submitted += 1
+            task = asyncio.create_task(run_one(client, prepare(body, args), result, args))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        after = await scrape_dispatch(client)
+    dispatch = {node: after.get(node, 0) - before.get(node, 0) for node in after}
+    return result.summary(elapsed, {node: count for node, count in sorted(dispatch.items()) if count})
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"elapsed     {report['elapsed_s']} s")
+    print(f"submitted   {report['submitted']}")
+    print(f"completed   {report['completed']}  ({report['throughput_rps']} req/s)")
+    for name in ("submit_latency_ms", "e2e_latency_ms"):
+        stats = report[name]
+        print(f"{name:<18}" + "  ".join(f"{k}={v}" for k, v in stats.items()))
+    print("outcomes    " + ", ".join(f"{k}={v}" for k, v in sorted(report["outcomes"].items())))
+    total = sum(report["per_node"].values()) or 1
+    for node, count in report["per_node"].items():
+        print(f"  {node:<24} {int(count):>6}  {count / total:6.1%}")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay generate requests against the balancer")
+    parser.add_argument("--url", default="http://127.0.0.1:7999", help="balancer 地址")
+    parser.add_argument("--requests", default="requests.sample.jsonl", help="每行一个 /api/generate 请求体")
+    parser.add_argument("--rps", type=float, default=2.0, help="目标提交速率")
+    parser.add_argument("--duration", type=float, default=30.0, help="发送时长(秒)，--count 为 0 时生效")
+    parser.add_argument("--count", type=int, default=0, help="总请求数，0 表示按 --duration")
+    parser.add_argument("--timeout", type=float, default=300.0, help="单个任务从提交到结束的超时(秒)")
+    parser.add_argument("--concurrency", type=int, default=200, help="HTTP 连接上限")
+    parser.add_argument("--no-cache", action="store_true", help="请求体加 cache=false，绕过结果缓存")
+    parser.add_argument("--random-seed", action="store_true", help="每个请求使用随机 seed")
+    parser.add_argument("--json", dest="json_path", help="报告另存为 JSON 文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+    本地一键压测: 启动 N 个假 ComfyUI、N 个 comfy-service 和一个 comfy-balancer，跑完 loadgen 后全部退出
+    需要本地 Redis(通过 REDIS_HOST/REDIS_PORT/REDIS_PASSWORD 环境变量配置)
+
+    python run_local.py --nodes 3 --rps 5 --duration 60 --latency 2 -- --no-cache --random-seed
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+import httpx
+
+import loadgen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.join(ROOT, "bench")
+
+
+def spawn(args: List[str], cwd: str, env: dict, log_dir: str, name: str) -> subprocess.Popen:
+    log = open(os.path.join(log_dir, f"{name}.log"), "w")
+    return subprocess.Popen([sys.executable, *args], cwd=cwd, env={**os.environ, **env}, stdout=log,
+                            stderr=subprocess.STDOUT)
+
+
+def wait_for_nodes(url: str, count: int, timeout: float):
+    """等到 balancer 的节点表里有足够多的健康节点"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            nodes = httpx.get(f"{url}/health", timeout=2).json().get("nodes", [])
+            if len([node for node in nodes if node.get("is_healthy")]) >= count:
+                return
+        except (httpx.HTTPError, ValueError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"balancer did not see {count} healthy nodes within {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the balancer, services and fake ComfyUI locally and load test")
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--balancer-port", type=int, default=7999)
+    parser.add_argument("--service-port", type=int, default=8101, help="第一个 service 的端口，依次递增")
+    parser.add_argument("--comfy-port", type=int, default=18000, help="第一个假 ComfyUI 的端口，依次递增")
+    parser.add_argument("--latency", type=float, default=2.0, help="假 ComfyUI 平均执行耗时(秒)")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rps", type=float, default=2.0)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--requests", default=os.path.join(BENCH, "requests.sample.jsonl"))
+    parser.add_argument("--log-dir", default=os.path.join(BENCH, "logs"))
+    parser.add_argument("--json", dest="json_path")
+    args, extra = parser.parse_known_args()
+    extra = [arg for arg in extra if arg != "--"]
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    processes: List[subprocess.Popen] = []
+    try:
+        for i in range(args.nodes):
+            comfy_port = args.comfy_port + i
+            service_port = args.service_port + i
+            processes.append(spawn([os.path.join(BENCH, "fake_comfyui.py"), "--port", str(comfy_port),
+                                    "--latency", str(args.latency), "--jitter", str(args.jitter),
+                                    "--error-rate", str(args.error_rate)],
+                                   BENCH, {}, args.log_dir, f"comfy-{i}"))
+            processes.append(spawn(["main.py"], os.path.join(ROOT, "comfy-service"), {
+                "COMFY_HOST": f"http://127.0.0.1:{comfy_port}",
+                "SERVICE_HOST": "127.0.0.1",
+                "SERVICE_PORT": str(service_port),
+            }, args.log_dir, f"service-{i}"))
+        processes.append(spawn(["main.py"], os.path.join(ROOT, "comfy-balancer"), {
+            "SERVICE_HOST": "127.0.0.1",
+            "SERVICE_PORT": str(args.balancer_port),
+        }, args.log_dir, "balancer"))
+
+        url = f"http://127.0.0.1:{args.balancer_port}"
+        wait_for_nodes(url, args.nodes, timeout=60)
+        argv = ["--url", url, "--requests", args.requests, "--rps", str(args.rps),
+                "--duration", str(args.duration), *extra]
+        if args.json_path:
+            argv += ["--json", args.json_path]
+        loadgen.main(argv)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import time
+from typing import List
+
+import config as global_config
+from models import TaskStatus
+from redis_store import pipeline, redis_client
+
+ACTIVE_KEY = "comfy:jobs:active"
+CLIENT_ACTIVE_KEY = "comfy:jobs:client:"
+
+# 原子地清理过期记录、检查全局与单客户端并发上限并占位
+# 返回 0 表示放行，1 表示超过全局上限，2 表示超过单客户端上限
+ADMIT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then return 1 end
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[5]) then return 2 end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+return 0
+"""
+
+# 批量版本，全部放行或全部拒绝；ARGV[6..] 为任务 id
+ADMIT_BATCH_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+local count = #ARGV - 5
+if redis.call('ZCARD', KEYS[1]) + count > tonumber(ARGV[3]) then return 1 end
+if redis.call('ZCARD', KEYS[2]) + count > tonumber(ARGV[4]) then return 2 end
+for i = 6, #ARGV do
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+    redis.call('ZADD', KEYS[2], ARGV[1], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return 0
+"""
+
+_admit = redis_client.register_script(ADMIT_SCRIPT)
+_admit_batch = redis_client.register_script(ADMIT_BATCH_SCRIPT)
+
+
+async def admit(job_id: str, client_id: str) -> int:
+    """申请一个执行名额，记录按时间排序，超过 TASK_TTL 未释放的视为泄漏自动清理"""
+    now = time.time()
+    return await _admit(
+        keys=[ACTIVE_KEY, f"{CLIENT_ACTIVE_KEY}{client_id}"],
+        args=[now, now - global_config.TASK_TTL, job_id,
+              global_config.JOB_MAX_ACTIVE, global_config.JOB_MAX_PER_CLIENT, global_config.TASK_TTL]
+    )
+
+
+async def admit_batch(job_ids: List[str], client_id: str) -> int:
+    """一次申请多个名额，返回值同 admit"""
+    now = time.time()
+    return await _admit_batch(
+        keys=[ACTIVE_KEY, f"{CLIENT_ACTIVE_KEY}{client_id}"],
+        args=[now, now - global_config.TASK_TTL, global_config.JOB_MAX_ACTIVE, global_config.JOB_MAX_PER_CLIENT,
+              global_config.TASK_TTL, *job_ids]
+    )
+
+
+async def release(task_status: TaskStatus):
+    """任务结束后释放名额"""
+    await release_jobs([task_status.task_id], task_status.client_id)
+
+
+async def release_jobs(job_ids: List[str], client_id: str):
+    """按任务 id 释放名额，入队失败时任务记录尚未写入"""
+    async with pipeline() as pipe:
+        pipe.zrem(ACTIVE_KEY, *job_ids)
+        pipe.zrem(f"{CLIENT_ACTIVE_KEY}{client_id}", *job_ids)
+        await pipe.execute()
@@ -22,12 +22,17 @@ API_PASSWORD = os.getenv("API_PASSWORD")
 JWT_SECRET = os.getenv("JWT_SECRET", "test-dev-secret-key")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRE_MINUTES = 3000
+# 已验证 token 缓存条数，缓存时间不超过 token 的过期时间
+JWT_CACHE_MAX = int(os.getenv("JWT_CACHE_MAX", 1024))
+JWT_CACHE_TTL = int(os.getenv("JWT_CACHE_TTL", 300))
 
 # Redis配置
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+# 连接池大小，所有请求处理协程共享
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
 
 # 服务配置
 SERVICE_HOST = os.getenv("SERVICE_HOST", "localhost")
@@ -37,3 +42,99 @@ SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8101))
 LOGDY_SERVER = os.getenv("LOGDY_SERVER", "logdy")
 LOGDY_PORT = int(os.getenv("LOGDY_PORT", 10800))
 LOGDY_API_KEY = os.getenv("LOGDY_API_KEY", "mypassword")
+
+# 节点注册表配置
+NODE_STATUS_KEY = "comfy:node:status:"
+NODE_EVENTS_CHANNEL = "comfy:node:events"
+# 心跳超过该秒数未更新视为不健康
+NODE_HEALTH_TIMEOUT = int(os.getenv("NODE_HEALTH_TIMEOUT", 10))
+# 兜底全量同步间隔(秒)，防止 pub/sub 断线期间漏掉心跳
+NODE_RESYNC_INTERVAL = int(os.getenv("NODE_RESYNC_INTERVAL", 30))
+
+# 节点HTTP连接池配置
+NODE_HTTP_MAX_CONNECTIONS = int(os.getenv("NODE_HTTP_MAX_CONNECTIONS", 200))
+NODE_HTTP_MAX_KEEPALIVE = int(os.getenv("NODE_HTTP_MAX_KEEPALIVE", 50))
+NODE_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("NODE_HTTP_KEEPALIVE_EXPIRY", 30))
+# 是否对节点启用HTTP/2，需要安装 httpx[http2] 且节点前有支持 h2 的代理
+NODE_HTTP2 = os.getenv("NODE_HTTP2", "false").lower() == "true"
+NODE_CONNECT_TIMEOUT = float(os.getenv("NODE_CONNECT_TIMEOUT", 3))
+# 各路由读超时(秒)
+NODE_GENERATE_TIMEOUT = float(os.getenv("NODE_GENERATE_TIMEOUT", 30))
+NODE_STATUS_TIMEOUT = float(os.getenv("NODE_STATUS_TIMEOUT", 10))
+
+# 负载均衡策略: least_outstanding / power_of_two / weighted_round_robin / utilization
+BALANCE_STRATEGY = os.getenv("BALANCE_STRATEGY", "least_outstanding")
+# 单节点排队上限，加权轮询时超过即跳过
+NODE_MAX_QUEUE = int(os.getenv("NODE_MAX_QUEUE", 4))
+# 使用率评分中每个排队任务的惩罚分
+QUEUE_PENALTY = float(os.getenv("QUEUE_PENALTY", 20))
+# 模型亲和: 已加载所需模型的节点负载比最空闲节点多出不超过该值时优先选择，小于 0 关闭
+MODEL_AFFINITY_SLACK = int(os.getenv("MODEL_AFFINITY_SLACK", 2))
+
+# 任务状态键
+TASK_KEY = "comfy:task:"
+TASK_TTL = int(os.getenv("TASK_TTL", 3600))
+# 任务已完成收尾的标记，保证收尾只执行一次
+TASK_FINISHED_KEY = "comfy:task:finished:"
+# prompt 索引键: 节点侧 prompt_id -> 所在节点与状态，分发和结束时更新
+PROMPT_INDEX_KEY = "comfy:prompt:"
+# 长轮询最大等待秒数
+TASK_WAIT_MAX = int(os.getenv("TASK_WAIT_MAX", 60))
+# 节点 SSE 流的读超时，需大于节点的保活间隔
+NODE_STREAM_TIMEOUT = float(os.getenv("NODE_STREAM_TIMEOUT", 60))
+# 节点 SSE 流断开后重连的最大退避(秒)
+NODE_STREAM_RETRY_MAX = float(os.getenv("NODE_STREAM_RETRY_MAX", 30))
+# SSE 保活间隔(秒)
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", 15))
+
+# 工作流目录缓存时间(秒)
+WORKFLOW_CATALOG_TTL = int(os.getenv("WORKFLOW_CATALOG_TTL", 60))
+# 工作流不存在或拉取失败的缓存时间(秒)，避免未知工作流的请求反复打到节点
+WORKFLOW_CATALOG_MISS_TTL = int(os.getenv("WORKFLOW_CATALOG_MISS_TTL", 5))
+# 结果缓存
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 86400))
+RESULT_CACHE_MAX = int(os.getenv("RESULT_CACHE_MAX", 10000))
+# 非确定性工作流，逗号分隔
+RESULT_CACHE_SKIP_WORKFLOWS = {name for name in os.getenv("RESULT_CACHE_SKIP_WORKFLOWS", "").split(",") if name}
+
+# 任务队列与准入控制
+JOB_MAX_ACTIVE = int(os.getenv("JOB_MAX_ACTIVE", 1000))
+# 单个客户端的活跃任务上限；请求未带 client_id 时按调用方地址计数(经反向代理时所有匿名请求共用代理地址)
+JOB_MAX_PER_CLIENT = int(os.getenv("JOB_MAX_PER_CLIENT", 50))
+# 分发失败的最大尝试次数
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# 分发者崩溃后，超过该毫秒数未确认的任务会被其他分发者接管
+JOB_CLAIM_IDLE_MS = int(os.getenv("JOB_CLAIM_IDLE_MS", 60000))
+JOB_CLAIM_INTERVAL = float(os.getenv("JOB_CLAIM_INTERVAL", 10))
+# 没有空闲节点时的等待间隔(秒)
+JOB_IDLE_INTERVAL = float(os.getenv("JOB_IDLE_INTERVAL", 0.2))
+# 分发器每轮最多并发分发的任务数(同时受各节点剩余队列深度限制)
+JOB_DISPATCH_BATCH = int(os.getenv("JOB_DISPATCH_BATCH", 16))
+# /api/generate/batch 单次最多任务数
+GENERATE_BATCH_MAX = int(os.getenv("GENERATE_BATCH_MAX", 100))
+# 任务请求体，重新分发时使用
+JOB_DATA_KEY = "comfy:jobs:data:"
+# 节点失联后任务最多重新提交的次数，及检查间隔(秒)
+JOB_MAX_RESUBMITS = int(os.getenv("JOB_MAX_RESUBMITS", 2))
+JOB_REAP_INTERVAL = float(os.getenv("JOB_REAP_INTERVAL", 5))
+# 节点疑似失联持续超过该数量的心跳间隔，且熔断已打开或探测失败，才重新提交其上的任务
+JOB_REAP_GRACE_BEATS = float(os.getenv("JOB_REAP_GRACE_BEATS", 5))
+# 客户端幂等键
+IDEMPOTENCY_KEY = "comfy:idem:"
+
+# 故障检测: 心跳丢失倍数、熔断阈值、退避(秒)、半开探测超时(秒)
+HEARTBEAT_MISS_FACTOR = float(os.getenv("HEARTBEAT_MISS_FACTOR", 2.5))
+CB_FAILURE_THRESHOLD = int(os.getenv("CB_FAILURE_THRESHOLD", 3))
+CB_BACKOFF_BASE = float(os.getenv("CB_BACKOFF_BASE", 1))
+CB_BACKOFF_MAX = float(os.getenv("CB_BACKOFF_MAX", 30))
+CB_PROBE_TIMEOUT = float(os.getenv("CB_PROBE_TIMEOUT", 10))
+
+# 链路追踪: 内存中保留的 trace 数，TRACE_FILE 非空时同时导出为 JSONL
+TRACE_MAX_TRACES = int(os.getenv("TRACE_MAX_TRACES", 2000))
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+# 生成图片的本地缓存目录、容量上限(字节)与流式转发分块大小
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", str(current_dir / "cache" / "images"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+IMAGE_CHUNK_SIZE = int(os.getenv("IMAGE_CHUNK_SIZE", 64 * 1024))
@@ -0,0 +1,113 @@
+import random
+import time
+from typing import Dict
+
+import config as global_config
+from logger import app_logger as logger
+from models import NodeStatus
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """单节点熔断器: closed 正常放行，open 拒绝，half_open 只放行一个探测请求"""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = 0.0
+        self.probe_until = 0.0
+
+    def available(self, now: float) -> bool:
+        if self.state == OPEN and now >= self.retry_at:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            return now >= self.probe_until
+        return self.state == CLOSED
+
+    def before_request(self, now: float):
+        if self.state == HALF_OPEN:
+            # 探测请求在途期间不再放行其它请求
+            self.probe_until = now + global_config.CB_PROBE_TIMEOUT
+
+    def on_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+
+    def on_failure(self, now: float, hard: bool) -> bool:
+        """记录一次失败，返回是否触发熔断"""
+        self.failures += 1
+        if self.state == HALF_OPEN or hard or self.failures >= global_config.CB_FAILURE_THRESHOLD:
+            self.trip(now)
+            return True
+        return False
+
+    def trip(self, now: float):
+        # 指数退避 + 抖动，避免所有节点同时恢复探测
+        self.trips += 1
+        backoff = min(global_config.CB_BACKOFF_BASE * 2 ** (self.trips - 1), global_config.CB_BACKOFF_MAX)
+        self.state = OPEN
+        self.failures = 0
+        self.retry_at = now + backoff * random.uniform(0.5, 1.5)
+
+
+class FailureDetector:
+    """
+        节点故障检测
+        结合心跳新鲜度(按节点上报的心跳间隔自适应)与转发请求的被动信号(连接失败、超时、5xx)
+    """
+
+    def __init__(self):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, node_key: str) -> CircuitBreaker:
+        breaker = self.breakers.get(node_key)
+        if breaker is None:
+            breaker = self.breakers[node_key] = CircuitBreaker()
+        return breaker
+
+    @staticmethod
+    def heartbeat_fresh(node: NodeStatus, now: float) -> bool:
+        """心跳超过上报间隔的 HEARTBEAT_MISS_FACTOR 倍未更新即视为失联，最长不超过 NODE_HEALTH_TIMEOUT"""
+        timeout = min(node.heartbeat_interval * global_config.HEARTBEAT_MISS_FACTOR,
+                      global_config.NODE_HEALTH_TIMEOUT)
+        return now - node.last_update < timeout
+
+    def is_available(self, node: NodeStatus, now: float) -> bool:
+        if node.draining or not node.comfy_online or not self.heartbeat_fresh(node, now):
+            return False
+        breaker = self.breakers.get(node.key)
+        return breaker is None or breaker.available(now)
+
+    def before_request(self, node_key: str):
+        breaker = self.breakers.get(node_key)
+        if breaker is not None:
+            breaker.before_request(time.time())
+
+    def record_success(self, node_key: str):
+        breaker = self.breakers.get(node_key)
+        if breaker is not None and breaker.state != CLOSED:
+            logger.info(f"节点恢复: {node_key}")
+            breaker.on_success()
+        elif breaker is not None:
+            breaker.failures = 0
+
+    def record_failure(self, node_key: str, hard: bool = False):
+        """hard 表示连接被拒等明确的宕机信号，立即熔断"""
+        if self.breaker(node_key).on_failure(time.time(), hard):
+            logger.warning(f"节点熔断: {node_key}")
+
+    def tripped(self, node_key: str) -> bool:
+        """熔断已打开(包括半开探测中)"""
+        breaker = self.breakers.get(node_key)
+        return breaker is not None and breaker.state != CLOSED
+
+    def states(self) -> Dict[str, str]:
+        return {node_key: breaker.state for node_key, breaker in self.breakers.items()}
+
+
+detector = FailureDetector()
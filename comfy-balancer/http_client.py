@@ -0,0 +1,106 @@
+import time
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException
+
+import config as global_config
+from failure_detector import detector
+from logger import app_logger as logger
+from metrics import UPSTREAM_REQUEST_DURATION, path_label
+from models import NodeStatus
+
+# 应用级共享的节点客户端，随 lifespan 创建和关闭
+_client: Optional[httpx.AsyncClient] = None
+
+
+def route_timeout(read: float) -> httpx.Timeout:
+    """按路由构造超时，连接超时统一"""
+    return httpx.Timeout(read, connect=global_config.NODE_CONNECT_TIMEOUT)
+
+
+GENERATE_TIMEOUT = route_timeout(global_config.NODE_GENERATE_TIMEOUT)
+STATUS_TIMEOUT = route_timeout(global_config.NODE_STATUS_TIMEOUT)
+
+
+class TimedTransport(httpx.AsyncHTTPTransport):
+    """记录每个节点请求到收到响应头的耗时，连接失败记为 error"""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await super().handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            UPSTREAM_REQUEST_DURATION.observe(time.perf_counter() - start, request.url.netloc.decode(),
+                                              path_label(request.url.path), status)
+
+
+async def start():
+    global _client
+    http2 = global_config.NODE_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("NODE_HTTP2 已开启但未安装 h2，回退到 HTTP/1.1")
+            http2 = False
+    _client = httpx.AsyncClient(
+        transport=TimedTransport(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=global_config.NODE_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=global_config.NODE_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=global_config.NODE_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        ),
+        timeout=STATUS_TIMEOUT,
+    )
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("http client is not started")
+    return _client
+
+
+def maybe_delivered(error: BaseException) -> bool:
+    """forward_request 的失败是否发生在请求发出之后(等待响应超时)，此时节点可能已经接收了请求"""
+    cause = error.__cause__
+    return (isinstance(cause, httpx.TimeoutException)
+            and not isinstance(cause, (httpx.ConnectTimeout, httpx.PoolTimeout)))
+
+
+async def forward_request(node: NodeStatus, path: str, method: str, data: dict = None,
+                          timeout: httpx.Timeout = None, headers: dict = None) -> httpx.Response:
+    """转发请求到选定的节点(复用应用级连接池)"""
+    client = get_client()
+    url = f"http://{node.host}:{node.port}/api{path}"  # 添加 /api 前缀
+    timeout = timeout or STATUS_TIMEOUT
+    if method.upper() not in ("GET", "POST"):
+        raise HTTPException(status_code=405, detail="Method not allowed")
+    detector.before_request(node.key)
+    try:
+        if method.upper() == "GET":
+            response = await client.get(url, timeout=timeout, headers=headers)
+        else:
+            response = await client.post(url, json=data, timeout=timeout, headers=headers)
+    except Exception as e:
+        logger.error(f"Error forwarding request to {url}: {e}")
+        # 连接失败说明节点已不可达，立即熔断；超时等按阈值计数
+        detector.record_failure(node.key, hard=isinstance(e, httpx.ConnectError))
+        raise HTTPException(status_code=502, detail="Error forwarding request") from e
+    if response.status_code >= 500:
+        detector.record_failure(node.key)
+    else:
+        detector.record_success(node.key)
+    return response
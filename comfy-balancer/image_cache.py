@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+import config as global_config
+import http_client
+from logger import app_logger as logger
+from models import NodeStatus, TaskStatus
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """解析单段 Range(bytes=start-end / start- / -suffix)，不合法或不满足时返回 None"""
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[6:].strip().partition("-")
+    try:
+        if not start_text:
+            length = int(end_text)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class ImageCache:
+    """
+        生成结果图片的本地磁盘缓存
+        图片按内容 sha256 存放(相同内容只存一份)，索引把 节点+ComfyUI 图片描述 映射到内容摘要；
+        总大小超过 IMAGE_CACHE_MAX_BYTES 时按最近访问时间淘汰
+        落盘和淘汰在线程中执行，索引与总大小的修改都在 _lock 内进行
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        self.index_dir = os.path.join(root, "index")
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.max_bytes = max_bytes
+        self.index: Dict[str, str] = {}
+        self.size = 0
+        # 内容摘要 -> 最近访问时间，只在内存中维护，淘汰时与文件 mtime 取大
+        self.atimes: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._evicting = False
+
+    @staticmethod
+    def key_for(node_key: str, image: Dict[str, str], variant: str = "") -> str:
+        """ComfyUI 输出文件名带递增序号，同一节点上的描述对应的内容不会再变化；variant 为转码参数"""
+        raw = "|".join((node_key, image.get("type", "output"), image.get("subfolder", ""), image.get("filename", ""),
+                        variant))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def lookup(self, key: str) -> Optional[str]:
+        digest = self.index.get(key)
+        if digest is None:
+            return None
+        self.atimes[digest] = time.time()
+        return self.blob_path(digest)
+
+    def _load(self):
+        for directory in (self.blob_dir, self.index_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+        for key in os.listdir(self.index_dir):
+            with open(os.path.join(self.index_dir, key), encoding="utf-8") as f:
+                self.index[key] = f.read().strip()
+        self.size = sum(entry.stat().st_size for sub in os.scandir(self.blob_dir) if sub.is_dir()
+                        for entry in os.scandir(sub.path))
+
+    def _commit(self, key: str, tmp_path: str, digest: str, size: int):
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+                self.size += size
+            with open(os.path.join(self.index_dir, key), "w", encoding="utf-8") as f:
+                f.write(digest)
+            self.index[key] = digest
+
+    def _evict(self):
+        """删除最久未访问的图片直到低于上限的 90%，并清理指向已删除内容的索引"""
+        blobs = []
+        for sub in os.scandir(self.blob_dir):
+            if sub.is_dir():
+                for entry in os.scandir(sub.path):
+                    stat = entry.stat()
+                    blobs.append((max(stat.st_mtime, self.atimes.get(entry.name, 0)), stat.st_size, entry.path))
+        blobs.sort()
+        target = self.max_bytes * 0.9
+        removed = set()
+        for _, size, path in blobs:
+            with self._lock:
+                if self.size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                self.size -= size
+            removed.add(os.path.basename(path))
+        with self._lock:
+            # 扫描之后可能有相同内容重新落盘，以删除后的文件状态为准
+            stale = [key for key, digest in self.index.items()
+                     if digest in removed and not os.path.exists(self.blob_path(digest))]
+            for key in stale:
+                self.atimes.pop(self.index.pop(key), None)
+                try:
+                    os.remove(os.path.join(self.index_dir, key))
+                except FileNotFoundError:
+                    pass
+
+    async def _maybe_evict(self):
+        if self.size <= self.max_bytes or self._evicting:
+            return
+        self._evicting = True
+        try:
+            await asyncio.to_thread(self._evict)
+        except Exception as e:
+            logger.error(f"Error evicting image cache: {e}")
+        finally:
+            self._evicting = False
+
+    async def fill(self, key: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """边转发边写入临时文件，完整读完后按内容摘要落盘，中途断开则丢弃"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        hasher = hashlib.sha256()
+        size = 0
+        complete = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete:
+                await asyncio.to_thread(self._commit, key, tmp_path, hasher.hexdigest(), size)
+                await self._maybe_evict()
+            else:
+                os.remove(tmp_path)
+
+    async def start(self):
+        await asyncio.to_thread(self._load)
+        logger.info(f"图片缓存: {len(self.index)} 条索引, {self.size} 字节")
+
+
+image_cache = ImageCache(global_config.IMAGE_CACHE_DIR, global_config.IMAGE_CACHE_MAX_BYTES)
+
+
+async def read_file(path: str, start: int, end: int) -> AsyncIterator[bytes]:
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(global_config.IMAGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def file_response(path: str, etag: str, media_type: str, range_header: Optional[str]) -> Response:
+    """从缓存文件应答，支持单段 Range"""
+    size = os.path.getsize(path)
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=31536000, immutable"}
+    start, end, status_code = 0, size - 1, 200
+    if range_header:
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(read_file(path, start, end), status_code=status_code, media_type=media_type,
+                             headers=headers)
+
+
+async def image_response(task_status: TaskStatus, node: NodeStatus, n: int, range_header: Optional[str],
+                         if_none_match: Optional[str], variant: Dict[str, str] = None) -> Response:
+    """
+        返回任务第 n 张图片: 命中缓存直接读本地文件，否则从节点流式拉取并同时写入缓存
+        带 Range 的未命中请求先完整拉取入缓存，再按范围应答；variant 为转码参数(format、width)，原样转给节点
+    """
+    query = urlencode(sorted((variant or {}).items()))
+    images = task_status.images or []
+    if n < 0 or n >= len(images):
+        raise HTTPException(status_code=404, detail="Image not found")
+    image = images[n]
+    key = image_cache.key_for(task_status.node, image, query)
+    etag = f'"{key}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    media_type = mimetypes.guess_type(image.get("filename", ""))[0] or "application/octet-stream"
+    if query:
+        media_type = f"image/{(variant.get('format') or 'webp').lower().replace('jpg', 'jpeg')}"
+
+    path = image_cache.lookup(key)
+    if path is not None:
+        try:
+            return file_response(path, etag, media_type, range_header)
+        except FileNotFoundError:
+            # 刚被淘汰，重新从节点拉取
+            pass
+
+    client = http_client.get_client()
+    url = f"http://{node.host}:{node.port}/api/task/{task_status.prompt_id}/images/{n}"
+    if query:
+        url = f"{url}?{query}"
+    try:
+        upstream = await client.send(client.build_request("GET", url, timeout=http_client.GENERATE_TIMEOUT),
+                                     stream=True)
+    except httpx.HTTPError as e:
+        logger.error(f"Error fetching image from {url}: {e}")
+        raise HTTPException(status_code=502, detail="Error fetching image")
+    if upstream.status_code != 200:
+        await upstream.aclose()
+        raise HTTPException(status_code=502 if upstream.status_code >= 500 else upstream.status_code,
+                            detail="Error fetching image")
+
+    chunks = image_cache.fill(key, upstream.aiter_bytes(global_config.IMAGE_CHUNK_SIZE))
+    if range_header:
+        try:
+            async for _ in chunks:
+                pass
+        finally:
+            await upstream.aclose()
+        path = image_cache.lookup(key)
+        if path is None:
+            raise HTTPException(status_code=502, detail="Error fetching image")
+        return file_response(path, etag, media_type, range_header)
+
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=31536000, immutable"}
+    if "content-length" in upstream.headers and "content-encoding" not in upstream.headers:
+        headers["Content-Length"] = upstream.headers["content-length"]
+    return StreamingResponse(chunks, media_type=media_type, headers=headers,
+                             background=BackgroundTask(upstream.aclose))
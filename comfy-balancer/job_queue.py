@@ -0,0 +1,459 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+
+import admission
+import config as global_config
+import http_client
+from failure_detector import detector
+from logger import app_logger as logger
+from metrics import DISPATCH, QUEUE_WAIT
+from models import NodeStatus, TaskStatus
+from node_registry import registry
+from result_cache import result_cache
+from redis_store import pipeline, redis_client
+from strategy import strategy, tracker
+from task_events import event_hub, finish_task
+from tracing import TRACE_HEADER, new_trace_id, tracer
+from workflow_catalog import workflow_catalog
+
+JOB_STREAM = "comfy:jobs"
+JOB_GROUP = "dispatchers"
+
+
+class JobQueue:
+    """
+        balancer 持有的任务队列(Redis Stream + 消费组)
+        /api/generate 只负责准入和入队，分发器在有节点空闲时才取任务提交，
+        任务 id 与最终执行的节点无关
+    """
+
+    def __init__(self):
+        self.consumer = f"{global_config.SERVICE_HOST}-{os.getpid()}"
+        self._tasks: List[asyncio.Task] = []
+        # 疑似失联的节点 -> 首次发现的时间
+        self.suspects: Dict[str, float] = {}
+
+    async def submit(self, data: dict, client_id: str, graph_hash: str = None,
+                     idempotency_key: str = None) -> Dict[str, Any]:
+        """
+            准入检查后入队，返回稳定的任务 id；相同幂等键的重复提交返回已有任务，
+            带 graph_hash 时先抢占执行中标记，相同 prompt 图已在执行(可能在其他 balancer 上)则合并到该任务
+        """
+        start = time.time()
+        if not registry.get_available_nodes():
+            raise HTTPException(status_code=503, detail="No available nodes")
+        job_id = uuid.uuid4().hex
+        idem_key = f"{global_config.IDEMPOTENCY_KEY}{client_id}:{idempotency_key}" if idempotency_key else None
+        if idem_key and not await redis_client.set(idem_key, job_id, nx=True, ex=global_config.TASK_TTL):
+            existing = await redis_client.get(idem_key)
+            if existing:
+                return {"task_id": existing, "duplicate": True}
+        if graph_hash:
+            existing = await result_cache.claim(graph_hash, job_id)
+            if existing:
+                if idem_key:
+                    await redis_client.set(idem_key, existing, ex=global_config.TASK_TTL)
+                return {"task_id": existing, "coalesced": True}
+        rejected = await admission.admit(job_id, client_id)
+        if rejected:
+            if idem_key:
+                await redis_client.delete(idem_key)
+            if graph_hash:
+                await result_cache.unclaim(graph_hash, job_id)
+            if rejected == 1:
+                raise HTTPException(status_code=429, detail="Too many active jobs")
+            raise HTTPException(status_code=429, detail="Too many active jobs for this client")
+
+        try:
+            task_status = await self._new_task(job_id, data, client_id, graph_hash)
+            async with pipeline() as pipe:
+                self._enqueue(pipe, task_status, data)
+                await pipe.execute()
+        except BaseException:
+            await self._abandon([job_id], client_id, [(graph_hash, job_id)] if graph_hash else [], idem_key)
+            raise
+        tracer.record(task_status.trace_id, "balancer.admit", start, time.time())
+        return {"task_id": job_id, "status": task_status.status}
+
+    async def submit_batch(self, jobs: List[dict], client_id: str,
+                           graph_hashes: List[Optional[str]]) -> List[Dict[str, Any]]:
+        """
+            批量入队: 一次准入(全部放行或全部拒绝)、一次管道写入，按顺序返回各任务 id
+            带 graph_hash 的任务先一次性抢占执行中标记，已在执行的合并到已有任务
+        """
+        start = time.time()
+        if not registry.get_available_nodes():
+            raise HTTPException(status_code=503, detail="No available nodes")
+        job_ids = [uuid.uuid4().hex for _ in jobs]
+        results: List[Optional[Dict[str, Any]]] = [None] * len(jobs)
+        hashed = [i for i, key in enumerate(graph_hashes) if key]
+        if hashed:
+            existing = await result_cache.claim_many([graph_hashes[i] for i in hashed], [job_ids[i] for i in hashed])
+            for i, task_id in zip(hashed, existing):
+                if task_id:
+                    results[i] = {"task_id": task_id, "coalesced": True}
+        claimed = [(graph_hashes[i], job_ids[i]) for i in hashed if results[i] is None]
+        pending = [i for i in range(len(jobs)) if results[i] is None]
+        if not pending:
+            return results
+        jobs = [jobs[i] for i in pending]
+        job_ids = [job_ids[i] for i in pending]
+        graph_hashes = [graph_hashes[i] for i in pending]
+        rejected = await admission.admit_batch(job_ids, client_id)
+        if rejected:
+            await asyncio.gather(*(result_cache.unclaim(key, task_id) for key, task_id in claimed))
+            if rejected == 1:
+                raise HTTPException(status_code=429, detail="Too many active jobs")
+            raise HTTPException(status_code=429, detail="Too many active jobs for this client")
+
+        try:
+            tasks = await asyncio.gather(*(self._new_task(job_id, data, client_id, key)
+                                           for job_id, data, key in zip(job_ids, jobs, graph_hashes)))
+            async with pipeline() as pipe:
+                for task_status, data in zip(tasks, jobs):
+                    self._enqueue(pipe, task_status, data)
+                await pipe.execute()
+        except BaseException:
+            await self._abandon(job_ids, client_id, claimed)
+            raise
+        end = time.time()
+        for i, task_status in zip(pending, tasks):
+            tracer.record(task_status.trace_id, "balancer.admit", start, end, batch=len(tasks))
+            results[i] = {"task_id": task_status.task_id, "status": task_status.status}
+        return results
+
+    @staticmethod
+    async def _abandon(job_ids: List[str], client_id: str, claimed: List[Tuple[str, str]],
+                       idem_key: Optional[str] = None):
+        """准入后入队失败: 归还名额，撤销执行中标记和幂等键，避免名额泄漏到 TASK_TTL 过期"""
+        try:
+            await admission.release_jobs(job_ids, client_id)
+            await asyncio.gather(*(result_cache.unclaim(key, task_id) for key, task_id in claimed))
+            if idem_key:
+                await redis_client.delete(idem_key)
+        except Exception as e:
+            logger.error(f"Error releasing admission for {job_ids}: {e}")
+
+    @staticmethod
+    async def _new_task(job_id: str, data: dict, client_id: str, graph_hash: Optional[str]) -> TaskStatus:
+        return TaskStatus(
+            task_id=job_id,
+            client_id=client_id,
+            timestamp=time.time(),
+            graph_hash=graph_hash,
+            workflow=data.get("workflow_name", ""),
+            trace_id=new_trace_id(),
+            models=await workflow_catalog.models(data)
+        )
+
+    @staticmethod
+    def _enqueue(pipe, task_status: TaskStatus, data: dict):
+        job_id = task_status.task_id
+        pipe.set(f"{global_config.TASK_KEY}{job_id}", task_status.json(), ex=global_config.TASK_TTL)
+        pipe.set(f"{global_config.JOB_DATA_KEY}{job_id}", json.dumps(data), ex=global_config.TASK_TTL)
+        pipe.xadd(JOB_STREAM, {"job_id": job_id, "attempts": 0, "exclude": ""})
+
+    @staticmethod
+    def capacity() -> int:
+        """所有健康节点剩余的队列深度之和"""
+        return sum(max(0, global_config.NODE_MAX_QUEUE - tracker.load(node))
+                   for node in registry.get_available_nodes())
+
+    @staticmethod
+    def select_node(exclude: Set[str] = frozenset(), models: Iterable[str] = ()) -> Optional[NodeStatus]:
+        """
+            在仍有空余队列深度的健康节点中按策略选择，跳过 exclude 中的节点，都满时返回 None
+            给出 models 时优先已加载全部所需模型的节点，只要其负载不比最空闲节点多出 MODEL_AFFINITY_SLACK
+        """
+        candidates = [node for node in registry.get_available_nodes()
+                      if node.key not in exclude and tracker.load(node) < global_config.NODE_MAX_QUEUE]
+        if not candidates:
+            return None
+        required = set(models)
+        if required and global_config.MODEL_AFFINITY_SLACK >= 0:
+            floor = min(tracker.load(node) for node in candidates)
+            warm = [node for node in candidates if required.issubset(node.models)
+                    and tracker.load(node) - floor <= global_config.MODEL_AFFINITY_SLACK]
+            if warm:
+                return strategy.select(warm)
+        return strategy.select(candidates)
+
+    async def _dispatch(self, entry_id: str, fields: Dict[str, str]):
+        job_id = fields["job_id"]
+        attempts = int(fields.get("attempts", 0))
+        exclude = {key for key in fields.get("exclude", "").split(",") if key}
+        async with pipeline() as pipe:
+            pipe.get(f"{global_config.TASK_KEY}{job_id}")
+            pipe.get(f"{global_config.JOB_DATA_KEY}{job_id}")
+            task_data, job_data = await pipe.execute()
+        if not task_data or not job_data:
+            # 任务已过期，直接丢弃
+            await self._ack(entry_id)
+            return
+        task_status = TaskStatus(**json.loads(task_data))
+        if task_status.done:
+            await self._ack(entry_id)
+            return
+        trace_id = task_status.trace_id
+        tracer.record(trace_id, "balancer.queue", task_status.timestamp, time.time(), attempts=attempts)
+        # 按任务所需模型选择，优先避开失败过的节点(都不可用时仍可选它们，可能已恢复)
+        select_start = time.time()
+        node = self.select_node(exclude, task_status.models) or self.select_node(models=task_status.models)
+        if node is None:
+            # 本轮并发分发的其他任务占满了节点
+            await self._requeue(entry_id, job_id, attempts, exclude)
+            return
+        tracer.record(trace_id, "balancer.select", select_start, time.time(), node=node.key,
+                      warm=set(task_status.models).issubset(node.models))
+        headers = {TRACE_HEADER: trace_id} if trace_id else None
+        # 任务 id 同时作为节点侧的幂等键，重试到同一节点也不会重复执行
+        payload = {**json.loads(job_data), "task_id": job_id}
+
+        while True:
+            attempts += 1
+            # 发出请求前先占用节点名额，同一轮并发分发的任务不会都选中同一个节点
+            tracker.dispatched(node.key, job_id)
+            rejected = None
+            try:
+                with tracer.span(trace_id, "balancer.dispatch", node=node.key, attempt=attempts) as span:
+                    response = await http_client.forward_request(node, "/generate", "POST", payload,
+                                                                 timeout=http_client.GENERATE_TIMEOUT,
+                                                                 headers=headers)
+                    span["status"] = response.status_code
+                if response.status_code >= 500:
+                    raise HTTPException(status_code=502, detail=f"node responded {response.status_code}")
+                if response.status_code >= 400:
+                    rejected = response.text[:200]
+                else:
+                    accepted = response.json()
+                    task_status.prompt_id = accepted["task_id"]
+                    # 节点把任务与其他任务合并执行时，图片不是用本任务的 seed 生成的
+                    task_status.cacheable = not accepted.get("coalesced", False)
+            except asyncio.CancelledError:
+                tracker.completed(job_id)
+                raise
+            except Exception as e:
+                if http_client.maybe_delivered(e) and await self._accepted_by(node, job_id):
+                    # 等待响应超时但节点已收下任务，换节点会重复生成
+                    logger.warning(f"Dispatch job {job_id} to {node.key} timed out, but the node has accepted it")
+                    task_status.prompt_id = job_id
+                    # 无法得知节点是否把它与其他任务合并执行，保守地不进入结果缓存
+                    task_status.cacheable = False
+                    break
+                # 连接失败、5xx 以及无法解析的响应都按分发失败处理，换节点或带上尝试次数重新排队
+                reason = e.detail if isinstance(e, HTTPException) else f"invalid response: {e!r}"
+                tracker.completed(job_id)
+                DISPATCH.inc(node.key, "failed")
+                exclude.add(node.key)
+                if attempts >= global_config.JOB_MAX_ATTEMPTS:
+                    await self._fail(entry_id, task_status, f"dispatch failed after {attempts} attempts")
+                    return
+                retry = self.select_node(exclude, task_status.models)
+                if retry is None:
+                    # 其他节点都满了，带上失败节点重新排队
+                    logger.warning(f"Dispatch job {job_id} to {node.key} failed ({reason}), requeue")
+                    await self._requeue(entry_id, job_id, attempts, exclude)
+                    return
+                logger.warning(f"Dispatch job {job_id} to {node.key} failed ({reason}), failover to {retry.key}")
+                node = retry
+                continue
+            if rejected is not None:
+                # 请求本身有误(工作流不存在、参数错误)，不重试
+                DISPATCH.inc(node.key, "rejected")
+                await self._fail(entry_id, task_status, f"node rejected the job: {rejected}")
+                return
+            break
+
+        task_status.node = node.key
+        task_status.status = "pending"
+        task_status.dispatched_at = time.time()
+        DISPATCH.inc(node.key, "accepted")
+        QUEUE_WAIT.observe(time.time() - task_status.timestamp)
+        async with pipeline() as pipe:
+            pipe.set(f"{global_config.TASK_KEY}{job_id}", task_status.json(), ex=global_config.TASK_TTL)
+            pipe.set(f"{global_config.PROMPT_INDEX_KEY}{task_status.prompt_id}", task_status.queue_item().json(),
+                     ex=global_config.TASK_TTL)
+            pipe.xack(JOB_STREAM, JOB_GROUP, entry_id)
+            pipe.xdel(JOB_STREAM, entry_id)
+            await pipe.execute()
+        event_hub.watch(task_status)
+
+    @staticmethod
+    async def _requeue(entry_id: str, job_id: str, attempts: int, exclude: Set[str]):
+        async with pipeline() as pipe:
+            pipe.xadd(JOB_STREAM, {"job_id": job_id, "attempts": attempts, "exclude": ",".join(exclude)})
+            pipe.xack(JOB_STREAM, JOB_GROUP, entry_id)
+            pipe.xdel(JOB_STREAM, entry_id)
+            await pipe.execute()
+
+    async def _fail(self, entry_id: str, task_status: TaskStatus, message: str):
+        task_status.status = "error"
+        task_status.message = message
+        await redis_client.set(f"{global_config.TASK_KEY}{task_status.task_id}", task_status.json(),
+                               ex=global_config.TASK_TTL)
+        await self._ack(entry_id)
+        await finish_task(task_status)
+        event_hub.detach(task_status)
+
+    async def resubmit(self, task_id: str, node_key: str):
+        """已被节点接收的任务在节点失联后重新入队，排除该节点"""
+        tracker.completed(task_id)
+        task_key = f"{global_config.TASK_KEY}{task_id}"
+        task_data = await redis_client.get(task_key)
+        if not task_data:
+            return
+        task_status = TaskStatus(**json.loads(task_data))
+        if task_status.done or task_status.node != node_key:
+            return
+        if task_status.resubmits >= global_config.JOB_MAX_RESUBMITS:
+            task_status.status = "error"
+            task_status.message = f"node {node_key} lost, resubmitted {task_status.resubmits} times"
+            await redis_client.set(task_key, task_status.json(), ex=global_config.TASK_TTL)
+            await finish_task(task_status)
+            event_hub.detach(task_status)
+            return
+        logger.warning(f"Node {node_key} lost, resubmit job {task_id}")
+        now = time.time()
+        tracer.record(task_status.trace_id, "balancer.lost", task_status.dispatched_at or now, now, node=node_key)
+        prompt_id = task_status.prompt_id
+        task_status.resubmits += 1
+        task_status.node = ""
+        task_status.prompt_id = None
+        task_status.status = "queued"
+        task_status.message = f"node {node_key} lost, resubmitted"
+        async with pipeline() as pipe:
+            pipe.set(task_key, task_status.json(), ex=global_config.TASK_TTL)
+            if prompt_id:
+                pipe.delete(f"{global_config.PROMPT_INDEX_KEY}{prompt_id}")
+            pipe.xadd(JOB_STREAM, {"job_id": task_id, "attempts": 0, "exclude": node_key})
+            await pipe.execute()
+        event_hub.detach(task_status)
+
+    @staticmethod
+    async def _accepted_by(node: NodeStatus, job_id: str) -> bool:
+        """
+            询问节点是否已收下任务(任务 id 即节点上的 prompt_id): 在 ComfyUI 队列中，或已开始执行/已完成；
+            节点对未知任务也会应答 pending，所以 pending 只认队列中的记录；查询失败视为未收下
+        """
+        try:
+            response = await http_client.forward_request(node, f"/queue/{job_id}", "GET")
+            if response.status_code == 200 and response.json().get("state") in ("running", "pending"):
+                return True
+            response = await http_client.forward_request(node, f"/task/{job_id}", "GET")
+            return response.status_code == 200 and response.json().get("status") in ("running", "success")
+        except Exception as e:
+            logger.warning(f"Query job {job_id} on {node.key} failed: {e}")
+            return False
+
+    @staticmethod
+    async def _probe(node_key: str, task_ids: List[str]) -> bool:
+        """查询节点上一个在途任务的状态，节点能正常应答返回 True"""
+        task_data = await redis_client.get(f"{global_config.TASK_KEY}{task_ids[0]}")
+        prompt_id = task_ids[0]
+        if task_data:
+            prompt_id = TaskStatus(**json.loads(task_data)).prompt_id or prompt_id
+        try:
+            response = await http_client.get_client().get(f"http://{node_key}/api/task/{prompt_id}")
+        except Exception as e:
+            logger.warning(f"Probe {node_key} failed: {e}")
+            return False
+        return response.status_code < 500
+
+    async def _reap(self):
+        """
+            定期检查在途任务所在节点，心跳超时、下线或 ComfyUI 不可用的节点在持续 JOB_REAP_GRACE_BEATS 个心跳间隔后，
+            若熔断已打开或探测其上的任务失败，才把任务重新提交到其他节点；繁忙节点偶尔的慢心跳不会导致重复执行
+        """
+        while True:
+            await asyncio.sleep(global_config.JOB_REAP_INTERVAL)
+            try:
+                now = time.time()
+                for node_key, tasks in list(tracker.tasks.items()):
+                    node = registry.nodes.get(node_key)
+                    if not tasks or (node is not None and node.comfy_online and detector.heartbeat_fresh(node, now)):
+                        self.suspects.pop(node_key, None)
+                        continue
+                    since = self.suspects.setdefault(node_key, now)
+                    interval = node.heartbeat_interval if node is not None else global_config.JOB_REAP_INTERVAL
+                    if now - since < interval * global_config.JOB_REAP_GRACE_BEATS:
+                        continue
+                    if not detector.tripped(node_key) and await self._probe(node_key, list(tasks)):
+                        continue
+                    self.suspects.pop(node_key, None)
+                    for task_id in list(tasks):
+                        await self.resubmit(task_id, node_key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job reaper error: {e}")
+
+    @staticmethod
+    async def _ack(entry_id: str):
+        async with pipeline() as pipe:
+            pipe.xack(JOB_STREAM, JOB_GROUP, entry_id)
+            pipe.xdel(JOB_STREAM, entry_id)
+            await pipe.execute()
+
+    async def _ensure_group(self):
+        try:
+            await redis_client.xgroup_create(JOB_STREAM, JOB_GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _run(self):
+        last_claim = 0
+        while True:
+            try:
+                await self._ensure_group()
+                while True:
+                    count = min(self.capacity(), global_config.JOB_DISPATCH_BATCH)
+                    if count <= 0:
+                        # 没有空闲节点就不取任务，留在队列里等待
+                        await asyncio.sleep(global_config.JOB_IDLE_INTERVAL)
+                        continue
+                    entries = []
+                    if time.time() - last_claim > global_config.JOB_CLAIM_INTERVAL:
+                        # 接管崩溃分发者遗留的未确认任务
+                        last_claim = time.time()
+                        claimed = await redis_client.xautoclaim(JOB_STREAM, JOB_GROUP, self.consumer,
+                                                                min_idle_time=global_config.JOB_CLAIM_IDLE_MS,
+                                                                count=count)
+                        entries = claimed[1]
+                    if not entries:
+                        result = await redis_client.xreadgroup(JOB_GROUP, self.consumer, {JOB_STREAM: ">"},
+                                                               count=count, block=500)
+                        entries = result[0][1] if result else []
+                    # 一轮取出的任务并发分发，各自选节点时已计入前面任务占用的名额
+                    jobs = []
+                    for entry_id, fields in entries:
+                        if not fields:
+                            await self._ack(entry_id)
+                            continue
+                        jobs.append(self._dispatch(entry_id, fields))
+                    for result in await asyncio.gather(*jobs, return_exceptions=True):
+                        if isinstance(result, Exception):
+                            logger.error(f"Job dispatch error: {result}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job dispatcher error: {e}")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._reap())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+job_queue = JobQueue()
@@ -1,25 +1,105 @@
 from loguru import logger
 import os
 import socket
+import threading
+import time
+import atexit
+from collections import deque
 
 LOGDY_SERVER = os.getenv("LOGDY_SERVER", "logdy")
 LOGDY_PORT = int(os.getenv("LOGDY_PORT", 10800))
 LOGDY_API_KEY = os.getenv("LOGDY_API_KEY", "mypassword")
 SERVICE_HOST = os.getenv("SERVICE_HOST", "comfy_balancer")
+# 日志发送缓冲区行数、每批行数、发送间隔(秒)
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", 10000))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 200))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 0.5))
 
 class TCPLoguruHandler(object):
     """
         基于TCP通道发送日志到logdy平台
+        write 只把日志放入有界环形缓冲区，由后台线程批量发送并自动重连，
+        缓冲区满时丢弃最旧的日志并计数，logdy 缓慢或断开不会阻塞请求处理
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, buffer_size=LOG_BUFFER_SIZE, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL):
         self.host = host
         self.port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.host, self.port))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.sock = None
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="logdy-sender", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
     def write(self, message):
-        self.sock.sendall(message.encode('utf-8'))
-    def __del__(self):
-        self.sock.close()
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(message)
+        if len(self.buffer) >= self.batch_size and not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=5)
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _take(self):
+        lines = []
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(f"logdy sender dropped {dropped} log lines\n")
+        while self.buffer and len(lines) < self.batch_size:
+            lines.append(self.buffer.popleft())
+        return lines
+
+    def _send(self, lines) -> bool:
+        try:
+            if self.sock is None:
+                self._connect()
+            self.sock.sendall("".join(lines).encode('utf-8'))
+            return True
+        except OSError:
+            self._close()
+            return False
+
+    def _run(self):
+        backoff = 0.5
+        pending = []
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            while self.buffer or pending or self.dropped:
+                pending = pending or self._take()
+                if not self._send(pending):
+                    # 发送失败保留这一批，退避后重连；期间新日志继续进入缓冲区
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 30)
+                    break
+                pending = []
+                backoff = 0.5
+
+    def stop(self):
+        """进程退出时尽量发送剩余日志"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join(timeout=2)
+        for _ in range(3):
+            lines = self._take()
+            if not lines or not self._send(lines):
+                break
+        self._close()
 
 class Logger:
     @staticmethod
@@ -30,12 +110,10 @@ class Logger:
         #     logger.remove()
 
         try:
-            logger.add(TCPLoguruHandler(host=LOGDY_SERVER, port=LOGDY_PORT), format="{time} {level} "+ SERVICE_HOST+" {message} ", level=f"{log_level}")
-        except Exception as e:
-            logger.error(f"Failed to add TCPLoguruHandler: {e}")
-
-        try:
-            logger.add(TCPLoguruHandler(host=LOGDY_SERVER, port=LOGDY_PORT), format="{time} {level} "+ SERVICE_HOST+" {message} ", level="ERROR")
+            # 两个 sink 共用一个发送线程和连接
+            handler = TCPLoguruHandler(host=LOGDY_SERVER, port=LOGDY_PORT)
+            logger.add(handler, format="{time} {level} "+ SERVICE_HOST+" {message} ", level=f"{log_level}")
+            logger.add(handler, format="{time} {level} "+ SERVICE_HOST+" {message} ", level="ERROR")
         except Exception as e:
             logger.error(f"Failed to add TCPLoguruHandler: {e}")
 
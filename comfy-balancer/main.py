@@ -1,19 +1,52 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import redis
 import json
-import httpx
-from typing import Dict, List
+import http_client
+from http_client import forward_request
+from typing import Dict, List, Optional
 import time
-from pydantic import BaseModel
-from typing import Optional
+import config as global_config
 from logger import Logger, app_logger as logger
+from models import NodeStatus, QueueItem, TaskStatus
+from node_registry import registry
+from failure_detector import detector
+from job_queue import job_queue
+from task_events import event_hub, finish_task
+from result_cache import result_cache
+from workflow_catalog import workflow_catalog
+from image_cache import image_cache, image_response
+from tracing import tracer
+import metrics
+import redis_store
+from redis_store import redis_client
 from web import create_app
 
 Logger.setup(False)
 
-app = FastAPI(title="Comfy Balancer")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动时加载节点表并订阅节点心跳
+    await registry.start()
+    await http_client.start()
+    # 启动任务分发器
+    await job_queue.start()
+    await tracer.start()
+    await image_cache.start()
+    yield
+    await job_queue.stop()
+    await tracer.stop()
+    await http_client.close()
+    await registry.stop()
+    await redis_store.close()
+
+
+# 文档路由由 web.create_app 注册(需登录)，关闭 FastAPI 自带的
+app = FastAPI(title="Comfy Balancer", docs_url=None, redoc_url=None, openapi_url=None, lifespan=lifespan)
 
 # CORS配置
 app.add_middleware(
@@ -23,219 +56,268 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 按路由记录请求耗时
+app.middleware("http")(metrics.track_request)
 
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 7999))
-# Redis配置
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
-REDIS_DB = int(os.getenv("REDIS_DB", 0))
-
-redis_client = redis.Redis(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    db=REDIS_DB,
-    password=REDIS_PASSWORD,
-    decode_responses=True
-)
-
-# 节点状态键前缀
-NODE_STATUS_KEY = "comfy:node:status:"
-NODE_QUEUE_KEY = "comfy:node:queue:"
-
-class NodeStatus(BaseModel):
-    host: str
-    port: int
-    cpu_usage: float
-    gpu_usage: float
-    last_update: float
-    is_healthy: Optional[bool] = None
-
-class QueueItem(BaseModel):
-    """队列项模型"""
-    client_id: str
-    prompt_id: str
-    timestamp: float
-    status: str = "waiting"  # waiting, processing, completed, failed
-
-class TaskStatus(BaseModel):
-    """任务状态模型"""
-    task_id: str
-    client_id: str
-    node: str
-    status: str = "pending"  # pending, success, error
-    message: str = ""
-    images: Optional[List[str]] = None
-    timestamp: float
 
 def get_available_nodes() -> List[NodeStatus]:
-    """获取所有可用节点的状态"""
-    nodes = []
-    for key in redis_client.keys(f"{NODE_STATUS_KEY}*"):
-        node_data = redis_client.get(key)
-        if node_data:
-            try:
-                node = NodeStatus(**json.loads(node_data))
-                # 检查节点是否健康（10秒内更新过）
-                if time.time() - node.last_update < 10:
-                    node.is_healthy = True
-                    nodes.append(node)
-                else:
-                    node.is_healthy = False
-            except Exception as e:
-                logger.error(f"Error parsing node data: {e}")
-    return nodes
-
-def select_best_node(nodes: List[NodeStatus]) -> NodeStatus:
-    """根据负载均衡策略选择最佳节点"""
-    if not nodes:
-        raise HTTPException(status_code=503, detail="No available nodes")
-    
-    # 首先过滤出健康的节点
-    healthy_nodes = [node for node in nodes if node.is_healthy]
-    if not healthy_nodes:
-        raise HTTPException(status_code=503, detail="No healthy nodes available")
-    
-    # 使用加权评分系统
-    # GPU使用率权重为0.7，CPU使用率权重为0.3
-    best_node = min(
-        healthy_nodes,
-        key=lambda x: (x.gpu_usage * 0.7 + x.cpu_usage * 0.3)
-    )
-    return best_node
-
-async def forward_request(node: NodeStatus, path: str, method: str, data: dict = None) -> httpx.Response:
-    """转发请求到选定的节点"""
-    async with httpx.AsyncClient() as client:
-        url = f"http://{node.host}:{node.port}/api{path}"  # 添加 /api 前缀
-        try:
-            if method.upper() == "GET":
-                response = await client.get(url)
-            elif method.upper() == "POST":
-                response = await client.post(url, json=data)
-            else:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-            return response
-        except Exception as e:
-            logger.error(f"Error forwarding request to {url}: {e}")
-            raise HTTPException(status_code=502, detail="Error forwarding request")
+    """获取所有可用节点的状态(本地节点表，无 Redis 往返)"""
+    return registry.get_available_nodes()
 
 @app.get("/health")
 async def health_check():
     """健康检查接口"""
     try:
         nodes = get_available_nodes()
-        return {"status": "healthy", "nodes": nodes}
+        return {"status": "healthy", "nodes": nodes, "breakers": detector.states()}
     except Exception as e:
         logger.error(f"Error in health check: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus 文本格式的性能指标"""
+    return await metrics.metrics_endpoint()
+
 @app.get("/queue/status/{prompt_id}")
 async def get_queue_status(prompt_id: str):
-    """获取队列中提示词的状态"""
+    """
+        获取提示词的状态: 按 prompt 索引一次读取所在节点与状态，
+        尚未结束时再向该节点查询在 ComfyUI 队列中的实时位置(position 为前面还有几个 prompt，0 表示执行中)
+    """
     try:
-        # 遍历所有节点查找提示词
-        for node in get_available_nodes():
-            queue_key = f"{NODE_QUEUE_KEY}{node.host}:{node.port}:{prompt_id}"
-            item_data = redis_client.get(queue_key)
-            if item_data:
-                queue_item = QueueItem(**json.loads(item_data))
-                return {
-                    "status": queue_item.status,
-                    "node": f"{node.host}:{node.port}",
-                    "timestamp": queue_item.timestamp
-                }
-        raise HTTPException(status_code=404, detail="Prompt not found in queue")
+        item_data = await redis_client.get(f"{global_config.PROMPT_INDEX_KEY}{prompt_id}")
+        if not item_data:
+            raise HTTPException(status_code=404, detail="Prompt not found in queue")
+        queue_item = QueueItem(**json.loads(item_data))
+        result = {
+            "status": queue_item.status,
+            "node": queue_item.node,
+            "task_id": queue_item.task_id,
+            "timestamp": queue_item.timestamp
+        }
+        node = registry.nodes.get(queue_item.node)
+        if queue_item.status == "waiting" and node is not None:
+            try:
+                response = await forward_request(node, f"/queue/{prompt_id}", "GET")
+                if response.status_code == 200:
+                    live = response.json()
+                    if live.get("state") == "running":
+                        result["status"] = "processing"
+                    result["position"] = live.get("position")
+                    result["queue_remaining"] = live.get("queue_remaining")
+            except HTTPException:
+                # 节点不可达时只返回索引中的状态
+                pass
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting queue status: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def client_key(data: dict, request: Request) -> str:
+    """准入计数用的客户端标识: 请求中的 client_id，未提供时用调用方地址，匿名请求同样受单客户端上限约束"""
+    client_id = data.get("client_id")
+    if client_id:
+        return str(client_id)
+    return f"addr:{request.client.host}" if request.client else "anonymous"
+
 @app.post("/api/generate")
-async def generate_image(data: dict):
-    """生成图片请求"""
+async def generate_image(data: dict, request: Request):
+    """
+        生成图片请求，入队后返回任务id；相同的 prompt 图优先复用已有结果或执行中的任务
+        客户端可通过 Idempotency-Key 请求头(或 idempotency_key 字段)安全地重试提交
+    """
     try:
-        logger.info(f"/api/generate params: {data}")
-        client_id = data.get("client_id", str(time.time()))
-        
-        # 获取可用节点
-        nodes = get_available_nodes()
-        if not nodes:
-            raise HTTPException(status_code=503, detail="No available nodes")
-        
-        # 选择最佳节点
-        best_node = select_best_node(nodes)
-        
-        # 转发请求到选定的节点
-        response = await forward_request(
-            best_node,
-            "/generate",
-            "POST",
-            data
-        )
-        
-        response_data = response.json()
-        task_id = response_data.get("task_id")
-        
-        # 记录任务状态
-        task_status = TaskStatus(
-            task_id=task_id,
-            client_id=client_id,
-            node=f"{best_node.host}:{best_node.port}",
-            timestamp=time.time()
-        )
+        logger.debug("/api/generate params: {}", data)
+        client_id = client_key(data, request)
+        idempotency_key = request.headers.get("Idempotency-Key") or data.pop("idempotency_key", None)
         
-        # 将任务状态写入Redis
-        task_key = f"comfy:task:{task_id}"
-        redis_client.set(task_key, task_status.json(), ex=3600)  # 1小时过期
+        graph_hash = await result_cache.key_for(data)
+        if graph_hash is None:
+            return await job_queue.submit(data, client_id, idempotency_key=idempotency_key)
         
-        return response_data
+        cached = await result_cache.lookup(graph_hash)
+        if cached is not None:
+            return cached
+        return await result_cache.coalesce(
+            graph_hash, lambda: job_queue.submit(data, client_id, graph_hash, idempotency_key))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/generate/batch")
+async def generate_batch(data: dict, request: Request):
+    """
+        批量生成请求: {"client_id": ..., "jobs": [请求体, ...]}，每个请求体与 /api/generate 相同
+        一次准入、一次 Redis 写入后按顺序返回全部任务 id，由分发器并发分发到各节点；
+        命中结果缓存或与执行中任务(包括本批内)相同的请求复用已有任务
+    """
+    jobs = data.get("jobs")
+    if not isinstance(jobs, list) or not jobs or not all(isinstance(job, dict) for job in jobs):
+        raise HTTPException(status_code=400, detail="jobs must be a non-empty list of objects")
+    if len(jobs) > global_config.GENERATE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"at most {global_config.GENERATE_BATCH_MAX} jobs per batch")
+    try:
+        logger.debug("/api/generate/batch params: {}", data)
+        client_id = client_key(data, request)
+        await workflow_catalog.preload(jobs)
+        keys = await asyncio.gather(*(result_cache.key_for(job) for job in jobs))
+        tasks = await result_cache.lookup_many(keys)
+
+        # 未命中的请求按 prompt 图哈希去重，不缓存的请求各自提交
+        groups: Dict[object, List[int]] = {}
+        for i, (key, task) in enumerate(zip(keys, tasks)):
+            if task is None:
+                groups.setdefault(key or i, []).append(i)
+        if groups:
+            submitted = await job_queue.submit_batch([jobs[indexes[0]] for indexes in groups.values()], client_id,
+                                                     [keys[indexes[0]] for indexes in groups.values()])
+            for indexes, task in zip(groups.values(), submitted):
+                tasks[indexes[0]] = task
+                for i in indexes[1:]:
+                    tasks[i] = {**task, "coalesced": True}
+        return {"tasks": tasks}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def task_node(task_status: TaskStatus) -> NodeStatus:
+    """任务所在节点，节点已从节点表消失时按地址构造"""
+    node = registry.nodes.get(task_status.node)
+    if node is not None:
+        return node
+    node_host, node_port = task_status.node.split(":")
+    return NodeStatus(
+        host=node_host,
+        port=int(node_port),
+        cpu_usage=0,
+        gpu_usage=0,
+        last_update=time.time()
+    )
+
+async def load_task(task_id: str) -> TaskStatus:
+    """从Redis读取任务并顺带续期，一次往返"""
+    task_key = f"{global_config.TASK_KEY}{task_id}"
+    async with redis_store.pipeline() as pipe:
+        pipe.get(task_key)
+        pipe.expire(task_key, global_config.TASK_TTL)
+        task_data, _ = await pipe.execute()
+    
+    if not task_data:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return TaskStatus(**json.loads(task_data))
+
 @app.get("/api/task/{task_id}")
-async def get_task_status(task_id: str):
-    """获取任务状态"""
+async def get_task_status(task_id: str, wait: int = 0):
+    """获取任务状态，wait>0 时长轮询等待任务结束(最多 TASK_WAIT_MAX 秒)"""
     try:
-        # 首先从Redis获取任务信息
-        task_key = f"comfy:task:{task_id}"
-        task_data = redis_client.get(task_key)
+        task_status = await load_task(task_id)
+        task_key = f"{global_config.TASK_KEY}{task_id}"
+        
+        # 已结束的任务直接返回Redis中的结果
+        if task_status.done:
+            return task_status.to_response()
         
-        if not task_data:
-            raise HTTPException(status_code=404, detail="Task not found")
+        if wait > 0:
+            latest = await event_hub.wait(task_status, min(wait, global_config.TASK_WAIT_MAX))
+            if latest is not None:
+                return latest
+            task_status = await load_task(task_id)
+            if task_status.done:
+                return task_status.to_response()
         
-        task_status = TaskStatus(**json.loads(task_data))
+        # 仍在balancer队列中，尚未分发到节点
+        if not task_status.prompt_id:
+            return {"status": task_status.status, "message": "Task is waiting for a free node.", "images": None}
         
         # 从对应节点获取最新状态
-        node_host, node_port = task_status.node.split(":")
-        node = NodeStatus(
-            host=node_host,
-            port=int(node_port),
-            cpu_usage=0,
-            gpu_usage=0,
-            last_update=time.time()
-        )
+        node = task_node(task_status)
         
-        response = await forward_request(
-            node,
-            f"/task/{task_id}",
-            "GET"
-        )
+        try:
+            response = await forward_request(
+                node,
+                f"/task/{task_status.prompt_id}",
+                "GET"
+            )
+        except HTTPException:
+            # 节点暂时不可达，返回已知状态；节点确认失联后任务会被重新提交
+            return task_status.to_response()
         
         # 更新任务状态
         response_data = response.json()
+        previous = (task_status.status, task_status.message)
         task_status.status = response_data.get("status", "pending")
         task_status.message = response_data.get("message", "")
         task_status.images = response_data.get("images", [])
         
-        # 更新Redis中的状态
-        redis_client.set(task_key, task_status.json(), ex=3600)
+        # 状态有变化时才回写Redis
+        if (task_status.status, task_status.message) != previous:
+            await redis_client.set(task_key, task_status.json(), ex=global_config.TASK_TTL)
+        
+        if task_status.done:
+            await finish_task(task_status)
         
         return response_data
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting task status: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/task/{task_id}/images/{n}")
+async def task_image(task_id: str, n: int, request: Request, format: Optional[str] = None,
+                     width: Optional[int] = None):
+    """任务第 n 张结果图片，经 balancer 缓存转发，支持 Range 与 ETag；format/width 请求缩略图或转码"""
+    task_status = await load_task(task_id)
+    if task_status.status != "success" or not task_status.node:
+        raise HTTPException(status_code=404, detail="Task has no images yet")
+    variant = {name: str(value) for name, value in (("format", format), ("width", width)) if value is not None}
+    return await image_response(task_status, task_node(task_status), n,
+                                request.headers.get("range"), request.headers.get("if-none-match"), variant)
+
+@app.get("/api/task/{task_id}/events")
+async def task_events(task_id: str):
+    """以SSE推送任务进度与完成事件，同一任务的所有客户端共享一条节点订阅"""
+    task_status = await load_task(task_id)
+    return StreamingResponse(
+        event_hub.stream(task_status),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/debug/trace/{task_id}")
+async def get_task_trace(task_id: str):
+    """任务各阶段耗时: balancer 本地记录的 span 加上执行节点记录的 span，按开始时间排序"""
+    task_status = await load_task(task_id)
+    if not task_status.trace_id:
+        raise HTTPException(status_code=404, detail="Task has no trace")
+    spans = tracer.get(task_status.trace_id)
+    if task_status.node:
+        try:
+            response = await forward_request(task_node(task_status), f"/trace/{task_status.trace_id}", "GET")
+            if response.status_code == 200:
+                spans.extend(response.json().get("spans", []))
+        except HTTPException:
+            pass
+    spans.sort(key=lambda span: span["start"])
+    stages: Dict[str, float] = {}
+    for span in spans:
+        stages[span["name"]] = round(stages.get(span["name"], 0) + span["duration_ms"], 2)
+    return {
+        "task_id": task_id,
+        "trace_id": task_status.trace_id,
+        "status": task_status.status,
+        "node": task_status.node,
+        "stages": stages,
+        "spans": spans
+    }
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,81 @@
+from pydantic import BaseModel
+from typing import Any, Dict, Optional, List
+
+
+class NodeStatus(BaseModel):
+    host: str
+    port: int
+    cpu_usage: float
+    gpu_usage: float
+    last_update: float
+    # ComfyUI 队列中剩余任务数(含执行中)、执行中任务数(心跳上报)
+    queue_remaining: int = 0
+    running: int = 0
+    # 空闲显存(字节)
+    vram_free: int = 0
+    # 节点服务正在处理的请求数
+    inflight: int = 0
+    # 节点当前的心跳间隔(秒)，忙碌时缩短
+    heartbeat_interval: float = 5
+    # ComfyUI 是否可达
+    comfy_online: bool = True
+    # 节点正在下线
+    draining: bool = False
+    weight: int = 1
+    # 节点最近使用过的模型，视为已在显存中
+    models: List[str] = []
+    is_healthy: Optional[bool] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.host}:{self.port}"
+
+
+class QueueItem(BaseModel):
+    """队列项模型"""
+    client_id: str
+    prompt_id: str
+    timestamp: float
+    status: str = "waiting"  # waiting, processing, completed, failed
+    node: str = ""
+    task_id: str = ""
+
+
+class TaskStatus(BaseModel):
+    """任务状态模型"""
+    task_id: str
+    client_id: str
+    # 分发前为空
+    node: str = ""
+    # 节点上 ComfyUI 的 prompt_id
+    prompt_id: Optional[str] = None
+    status: str = "queued"  # queued, pending, running, success, error
+    message: str = ""
+    images: Optional[List[Dict[str, Any]]] = None
+    timestamp: float
+    # 完整 prompt 图的哈希，用于结果缓存
+    graph_hash: Optional[str] = None
+    # 节点失联后被重新提交的次数
+    resubmits: int = 0
+    # 工作流名称，用于按工作流统计耗时
+    workflow: str = ""
+    # 任务需要的模型，用于优先分发到已加载这些模型的节点
+    models: List[str] = []
+    # 结果能否写入结果缓存，节点合并执行的任务为 False
+    cacheable: bool = True
+    # 链路追踪 id 及分发到节点的时间
+    trace_id: Optional[str] = None
+    dispatched_at: float = 0
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("success", "error")
+
+    def to_response(self) -> Dict[str, Any]:
+        return {"status": self.status, "message": self.message, "images": self.images}
+
+    def queue_item(self) -> QueueItem:
+        """prompt 索引中保存的记录"""
+        status = {"success": "completed", "error": "failed"}.get(self.status, "waiting")
+        return QueueItem(client_id=self.client_id, prompt_id=self.prompt_id or "", timestamp=self.timestamp,
+                         status=status, node=self.node, task_id=self.task_id)
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+
+import config as global_config
+from logger import app_logger as logger
+from failure_detector import detector
+from models import NodeStatus
+from redis_store import redis_client
+
+
+class NodeRegistry:
+    """
+        本地节点表
+        启动时通过 SCAN+MGET 全量加载一次，之后由节点心跳的 pub/sub 消息增量更新，
+        选节点时不再访问 Redis
+    """
+
+    def __init__(self):
+        self.client = redis_client
+        self.nodes: Dict[str, NodeStatus] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def apply(self, node_data: str) -> Optional[NodeStatus]:
+        """合并一条心跳数据，旧于本地记录的消息直接丢弃"""
+        try:
+            node = NodeStatus(**json.loads(node_data))
+        except Exception as e:
+            logger.error(f"Error parsing node data: {e}")
+            return None
+        current = self.nodes.get(node.key)
+        if current is None or node.last_update >= current.last_update:
+            self.nodes[node.key] = node
+        return node
+
+    async def seed(self):
+        """SCAN+MGET 全量同步，Redis 中已过期的节点从本地表移除"""
+        keys = [key async for key in self.client.scan_iter(match=f"{global_config.NODE_STATUS_KEY}*", count=100)]
+        seen = set()
+        if keys:
+            for node_data in await self.client.mget(keys):
+                if node_data:
+                    node = self.apply(node_data)
+                    if node:
+                        seen.add(node.key)
+        for key in list(self.nodes.keys()):
+            if key not in seen:
+                self.nodes.pop(key, None)
+        logger.info(f"节点表同步完成: {len(self.nodes)} 个节点")
+
+    def get_available_nodes(self) -> List[NodeStatus]:
+        """获取所有可用节点的状态"""
+        now = time.time()
+        nodes = []
+        for node in self.nodes.values():
+            # 心跳新鲜度 + 熔断状态
+            node.is_healthy = detector.is_available(node, now)
+            if node.is_healthy:
+                nodes.append(node)
+        return nodes
+
+    async def _listen(self):
+        """订阅心跳频道，断线后重新订阅并全量同步一次"""
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(global_config.NODE_EVENTS_CHANNEL)
+                await self.seed()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.apply(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Node events subscription error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    async def _resync(self):
+        while True:
+            await asyncio.sleep(global_config.NODE_RESYNC_INTERVAL)
+            try:
+                await self.seed()
+            except Exception as e:
+                logger.error(f"Error resyncing node registry: {e}")
+
+    async def start(self):
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._resync()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+registry = NodeRegistry()
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import config as global_config
+from logger import app_logger as logger
+from models import TaskStatus
+from redis_store import pipeline, redis_client
+from workflow_catalog import graph_hash, workflow_catalog
+
+RESULT_KEY = "comfy:result:"
+RESULT_INDEX_KEY = "comfy:result:index"
+INFLIGHT_KEY = "comfy:result:inflight:"
+
+# 只删除仍属于该任务的执行中标记
+UNCLAIM_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+_unclaim = redis_client.register_script(UNCLAIM_SCRIPT)
+
+
+class ResultCache:
+    """
+        生成结果缓存，键为完整 prompt 图的规范化哈希
+        命中直接返回已有结果；相同请求在执行中时合并到同一个任务
+    """
+
+    def __init__(self):
+        # 本进程内正在分发的请求，同一哈希的并发请求等待同一次分发
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def enabled_for(data: dict) -> bool:
+        """非确定性工作流可通过请求中的 cache=false 或 RESULT_CACHE_SKIP_WORKFLOWS 关闭缓存"""
+        return (global_config.RESULT_CACHE_ENABLED
+                and data.get("cache", True) is not False
+                and data.get("workflow_name") not in global_config.RESULT_CACHE_SKIP_WORKFLOWS)
+
+    async def key_for(self, data: dict) -> Optional[str]:
+        if not self.enabled_for(data):
+            return None
+        graph = await workflow_catalog.resolve(data)
+        return graph_hash(graph) if graph is not None else None
+
+    async def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询已完成结果或执行中的任务，均未命中返回 None"""
+        result_data, inflight_task = await redis_client.mget(f"{RESULT_KEY}{key}", f"{INFLIGHT_KEY}{key}")
+        if result_data:
+            task_status = TaskStatus(**json.loads(result_data))
+            # 任务键可能已过期，补写一份让后续的状态查询可用
+            await redis_client.set(f"{global_config.TASK_KEY}{task_status.task_id}", result_data,
+                                   ex=global_config.TASK_TTL, nx=True)
+            return {"task_id": task_status.task_id, "cached": True, **task_status.to_response()}
+        if inflight_task:
+            return {"task_id": inflight_task, "coalesced": True}
+        return None
+
+    async def lookup_many(self, keys: List[Optional[str]]) -> List[Optional[Dict[str, Any]]]:
+        """批量版 lookup，所有键一次 MGET；None 键(不缓存的请求)直接返回 None"""
+        present = [key for key in keys if key]
+        if not present:
+            return [None] * len(keys)
+        values = await redis_client.mget(*[f"{RESULT_KEY}{key}" for key in present],
+                                         *[f"{INFLIGHT_KEY}{key}" for key in present])
+        found: Dict[str, Dict[str, Any]] = {}
+        async with pipeline() as pipe:
+            for key, result_data, inflight_task in zip(present, values[:len(present)], values[len(present):]):
+                if result_data:
+                    task_status = TaskStatus(**json.loads(result_data))
+                    pipe.set(f"{global_config.TASK_KEY}{task_status.task_id}", result_data,
+                             ex=global_config.TASK_TTL, nx=True)
+                    found[key] = {"task_id": task_status.task_id, "cached": True, **task_status.to_response()}
+                elif inflight_task:
+                    found[key] = {"task_id": inflight_task, "coalesced": True}
+            await pipe.execute()
+        return [found.get(key) if key else None for key in keys]
+
+    @staticmethod
+    async def claim_many(keys: List[str], task_ids: List[str]) -> List[Optional[str]]:
+        """
+            入队前用 SET NX 写入执行中标记，多个 balancer 同时收到相同的 prompt 图时只有一个执行
+            返回与 keys 对应的列表: 抢到为 None，否则为已在执行的任务 id
+        """
+        async with pipeline() as pipe:
+            for key, task_id in zip(keys, task_ids):
+                pipe.set(f"{INFLIGHT_KEY}{key}", task_id, nx=True, ex=global_config.TASK_TTL)
+                pipe.get(f"{INFLIGHT_KEY}{key}")
+            results = await pipe.execute()
+        return [None if claimed else existing for claimed, existing in zip(results[::2], results[1::2])]
+
+    async def claim(self, key: str, task_id: str) -> Optional[str]:
+        return (await self.claim_many([key], [task_id]))[0]
+
+    @staticmethod
+    async def unclaim(key: str, task_id: str):
+        """入队失败时撤销执行中标记"""
+        await _unclaim(keys=[f"{INFLIGHT_KEY}{key}"], args=[task_id])
+
+    async def coalesce(self, key: str, dispatch: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """同一进程内相同哈希的并发请求只分发一次"""
+        future = self.pending.get(key)
+        if future is not None:
+            response_data = await asyncio.shield(future)
+            return {**response_data, "coalesced": True}
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            response_data = await dispatch()
+            future.set_result(response_data)
+            return response_data
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有等待者时避免 "exception was never retrieved" 告警
+            future.exception()
+            raise
+        finally:
+            self.pending.pop(key, None)
+
+    async def store(self, task_status: TaskStatus):
+        """任务结束时写入结果缓存(仅成功且可缓存的结果)，并清理执行中标记"""
+        key = task_status.graph_hash
+        if not key:
+            return
+        try:
+            async with pipeline() as pipe:
+                pipe.delete(f"{INFLIGHT_KEY}{key}")
+                if task_status.status == "success" and task_status.cacheable:
+                    pipe.set(f"{RESULT_KEY}{key}", task_status.json(), ex=global_config.RESULT_CACHE_TTL)
+                    pipe.zadd(RESULT_INDEX_KEY, {key: time.time()})
+                    pipe.zcard(RESULT_INDEX_KEY)
+                results = await pipe.execute()
+            if task_status.status == "success" and task_status.cacheable and results[-1] > global_config.RESULT_CACHE_MAX:
+                await self._trim(results[-1] - global_config.RESULT_CACHE_MAX)
+        except Exception as e:
+            logger.error(f"Error storing result cache for {task_status.task_id}: {e}")
+
+    @staticmethod
+    async def _trim(count: int):
+        """超出容量时淘汰最早写入的结果"""
+        evicted = await redis_client.zpopmin(RESULT_INDEX_KEY, count)
+        if evicted:
+            await redis_client.delete(*[f"{RESULT_KEY}{key}" for key, _ in evicted])
+
+
+result_cache = ResultCache()
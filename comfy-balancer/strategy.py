@@ -0,0 +1,131 @@
+import random
+import time
+from typing import Dict, List, Type
+
+import config as global_config
+from models import NodeStatus
+
+
+class LoadTracker:
+    """
+        balancer 自己记录的在途任务数
+        分发时 +1，查询到任务完成(success/error)时 -1，不依赖 5 秒一次的心跳
+    """
+
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self.tasks: Dict[str, Dict[str, float]] = {}
+        self.task_nodes: Dict[str, str] = {}
+        self._last_prune = time.time()
+
+    def dispatched(self, node_key: str, task_id: str):
+        now = time.time()
+        self.tasks.setdefault(node_key, {})[task_id] = now
+        self.task_nodes[task_id] = node_key
+        if now - self._last_prune > 60:
+            self.prune(now)
+
+    def completed(self, task_id: str):
+        node_key = self.task_nodes.pop(task_id, None)
+        if node_key is not None:
+            self.tasks.get(node_key, {}).pop(task_id, None)
+
+    def outstanding(self, node_key: str) -> int:
+        return len(self.tasks.get(node_key, ()))
+
+    def prune(self, now: float):
+        """清理从未查询到完成状态的过期任务，避免计数泄漏"""
+        self._last_prune = now
+        for node_key, tasks in self.tasks.items():
+            for task_id in [t for t, ts in tasks.items() if now - ts > self.ttl]:
+                tasks.pop(task_id, None)
+                self.task_nodes.pop(task_id, None)
+
+    def load(self, node: NodeStatus) -> int:
+        """节点负载: 本地在途数与节点上报的 ComfyUI 队列长度取大"""
+        return max(self.outstanding(node.key), node.queue_remaining)
+
+
+class Strategy:
+    """负载均衡策略基类"""
+    name = ""
+
+    def __init__(self, tracker: LoadTracker):
+        self.tracker = tracker
+
+    def select(self, nodes: List[NodeStatus]) -> NodeStatus:
+        raise NotImplementedError
+
+
+class LeastOutstandingStrategy(Strategy):
+    """最少在途任务，负载相同时按资源使用率打破平局"""
+    name = "least_outstanding"
+
+    def select(self, nodes: List[NodeStatus]) -> NodeStatus:
+        return min(nodes, key=lambda x: (self.tracker.load(x), x.gpu_usage * 0.7 + x.cpu_usage * 0.3))
+
+
+class PowerOfTwoStrategy(Strategy):
+    """随机取两个节点，选负载较低的一个"""
+    name = "power_of_two"
+
+    def select(self, nodes: List[NodeStatus]) -> NodeStatus:
+        if len(nodes) == 1:
+            return nodes[0]
+        a, b = random.sample(nodes, 2)
+        return a if self.tracker.load(a) <= self.tracker.load(b) else b
+
+
+class WeightedRoundRobinStrategy(Strategy):
+    """平滑加权轮询，队列已满的节点暂时跳过"""
+    name = "weighted_round_robin"
+
+    def __init__(self, tracker: LoadTracker):
+        super().__init__(tracker)
+        self.current: Dict[str, float] = {}
+
+    def select(self, nodes: List[NodeStatus]) -> NodeStatus:
+        candidates = [x for x in nodes if self.tracker.load(x) < global_config.NODE_MAX_QUEUE] or nodes
+        total = 0
+        best = None
+        for node in candidates:
+            weight = max(node.weight, 1)
+            total += weight
+            self.current[node.key] = self.current.get(node.key, 0) + weight
+            if best is None or self.current[node.key] > self.current[best.key]:
+                best = node
+        self.current[best.key] -= total
+        return best
+
+
+class UtilizationStrategy(Strategy):
+    """原有的资源使用率评分，叠加队列长度惩罚"""
+    name = "utilization"
+
+    def select(self, nodes: List[NodeStatus]) -> NodeStatus:
+        # GPU使用率权重为0.7，CPU使用率权重为0.3，每个排队任务折算 QUEUE_PENALTY 分
+        return min(
+            nodes,
+            key=lambda x: (x.gpu_usage * 0.7 + x.cpu_usage * 0.3
+                           + self.tracker.load(x) * global_config.QUEUE_PENALTY)
+        )
+
+
+STRATEGIES: Dict[str, Type[Strategy]] = {
+    cls.name: cls for cls in (
+        LeastOutstandingStrategy,
+        PowerOfTwoStrategy,
+        WeightedRoundRobinStrategy,
+        UtilizationStrategy,
+    )
+}
+
+
+def create_strategy(name: str, tracker: LoadTracker) -> Strategy:
+    if name not in STRATEGIES:
+        raise ValueError(f"unknown balance strategy: {name}, available: {list(STRATEGIES)}")
+    return STRATEGIES[name](tracker)
+
+
+tracker = LoadTracker()
+strategy = create_strategy(global_config.BALANCE_STRATEGY, tracker)
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+
+import httpx
+
+import config as global_config
+import http_client
+from logger import app_logger as logger
+from metrics import GENERATION_DURATION
+from models import TaskStatus
+from redis_store import pipeline, redis_client
+from result_cache import result_cache
+from strategy import tracker
+from tracing import tracer
+import admission
+
+
+class TaskChannel:
+    """单个任务的上游订阅，所有等待该任务的客户端共享"""
+
+    def __init__(self, task_status: TaskStatus):
+        self.task_status = task_status
+        self.latest: Optional[Dict[str, Any]] = None
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.pump: Optional[asyncio.Task] = None
+        # 由分发器登记的跟踪，没有客户端订阅时也保持到任务结束
+        self.watched = False
+
+    @property
+    def done(self) -> bool:
+        return self.latest is not None and self.latest.get("status") in ("success", "error")
+
+
+class TaskEventHub:
+    """
+        任务进度扇出
+        每个任务只向节点建立一条 SSE 订阅，再分发给本地的 SSE 客户端和长轮询请求
+    """
+
+    def __init__(self):
+        self.channels: Dict[str, TaskChannel] = {}
+
+    def _channel(self, task_status: TaskStatus) -> TaskChannel:
+        channel = self.channels.get(task_status.task_id)
+        if channel is None:
+            channel = self.channels[task_status.task_id] = TaskChannel(task_status)
+        elif task_status.prompt_id and (task_status.node, task_status.prompt_id) != \
+                (channel.task_status.node, channel.task_status.prompt_id):
+            # 任务被重新分发到了其他节点，改订新节点
+            channel.task_status = task_status
+            self._drop_pump(channel)
+        # 排队中的任务还没有节点，等分发后再建立上游订阅
+        if channel.pump is None and task_status.prompt_id:
+            channel.pump = asyncio.create_task(self._pump(channel))
+        return channel
+
+    def watch(self, task_status: TaskStatus):
+        """分发后立即跟踪任务直到结束，保证计数、准入名额和结果缓存及时更新"""
+        self._channel(task_status).watched = True
+
+    def subscribe(self, task_status: TaskStatus) -> Tuple[TaskChannel, asyncio.Queue]:
+        channel = self._channel(task_status)
+        queue = asyncio.Queue()
+        channel.subscribers.add(queue)
+        if channel.latest is not None:
+            queue.put_nowait(channel.latest)
+        return channel, queue
+
+    def unsubscribe(self, channel: TaskChannel, queue: asyncio.Queue):
+        channel.subscribers.discard(queue)
+        if not channel.subscribers and not channel.watched:
+            # 没有等待者了就断开上游订阅
+            self.channels.pop(channel.task_status.task_id, None)
+            if channel.pump is not None and not channel.pump.done():
+                channel.pump.cancel()
+
+    @staticmethod
+    def _drop_pump(channel: TaskChannel):
+        pump, channel.pump = channel.pump, None
+        if pump is not None and not pump.done():
+            pump.cancel()
+
+    def detach(self, task_status: TaskStatus):
+        """任务离开原节点(重新入队或分发失败): 断开上游订阅，把当前状态推给订阅者"""
+        channel = self.channels.get(task_status.task_id)
+        if channel is None:
+            return
+        channel.task_status = task_status
+        self._drop_pump(channel)
+        self._publish(channel, task_status.to_response())
+        if task_status.done:
+            self.channels.pop(task_status.task_id, None)
+            for queue in channel.subscribers:
+                queue.put_nowait(None)
+
+    def _publish(self, channel: TaskChannel, data: Dict[str, Any]):
+        channel.latest = data
+        for queue in channel.subscribers:
+            queue.put_nowait(data)
+
+    async def _persist(self, task_status: TaskStatus, data: Dict[str, Any]):
+        """任务结束后回写 Redis，之后的查询不再访问节点"""
+        task_status.status = data.get("status", "pending")
+        task_status.message = data.get("message", "")
+        task_status.images = data.get("images") or []
+        await redis_client.set(f"{global_config.TASK_KEY}{task_status.task_id}", task_status.json(),
+                               ex=global_config.TASK_TTL)
+        await finish_task(task_status)
+
+    async def _pump(self, channel: TaskChannel):
+        task_status = channel.task_status
+        url = f"http://{task_status.node}/api/task/{task_status.prompt_id}/events"
+        timeout = httpx.Timeout(global_config.NODE_STREAM_TIMEOUT, connect=global_config.NODE_CONNECT_TIMEOUT)
+        attempts = 0
+        try:
+            # 分发器跟踪的任务一直重连，直到任务结束或节点被判定失联(由 job_queue 的 reaper 重新提交并 detach)；
+            # 只有客户端订阅的任务重试 3 次后放弃
+            while not channel.done and (channel.watched or attempts < 3):
+                attempts += 1
+                try:
+                    async with http_client.get_client().stream("GET", url, timeout=timeout) as response:
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            attempts = 0
+                            data = json.loads(line[5:])
+                            if data.get("status") in ("success", "error"):
+                                # 先落库再通知，避免最后一个订阅者离开时取消掉回写
+                                await asyncio.shield(self._persist(task_status, data))
+                            self._publish(channel, data)
+                            if channel.done:
+                                break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error streaming task {task_status.task_id} from {task_status.node}: {e}")
+                    await asyncio.sleep(min(2 ** (attempts - 1), global_config.NODE_STREAM_RETRY_MAX))
+        finally:
+            # 已被替换的旧订阅直接退出，不影响等待新节点结果的订阅者
+            if channel.pump is asyncio.current_task():
+                if self.channels.get(task_status.task_id) is channel:
+                    self.channels.pop(task_status.task_id, None)
+                for queue in channel.subscribers:
+                    queue.put_nowait(None)
+
+    async def stream(self, task_status: TaskStatus) -> AsyncIterator[str]:
+        """SSE 输出，任务已结束时只推送一次最终状态"""
+        if task_status.done:
+            yield f"data: {json.dumps(task_status.to_response())}\n\n"
+            return
+        channel, queue = self.subscribe(task_status)
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(queue.get(), timeout=global_config.SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if data is None:
+                    break
+                yield f"data: {json.dumps(data)}\n\n"
+                if data.get("status") in ("success", "error"):
+                    break
+        finally:
+            self.unsubscribe(channel, queue)
+
+    async def wait(self, task_status: TaskStatus, timeout: float) -> Optional[Dict[str, Any]]:
+        """长轮询: 等到任务结束或超时，返回最近一次状态"""
+        channel, queue = self.subscribe(task_status)
+        try:
+            await asyncio.wait_for(self._wait_done(queue), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.unsubscribe(channel, queue)
+        return channel.latest
+
+    @staticmethod
+    async def _wait_done(queue: asyncio.Queue):
+        while True:
+            data = await queue.get()
+            if data is None or data.get("status") in ("success", "error"):
+                return
+
+
+async def finish_task(task_status: TaskStatus):
+    """任务结束的统一收尾: 在途计数、请求体、结果缓存、准入名额；节点推送和轮询可能都走到这里，只执行一次"""
+    tracker.completed(task_status.task_id)
+    if not await redis_client.set(f"{global_config.TASK_FINISHED_KEY}{task_status.task_id}", 1, nx=True,
+                                  ex=global_config.TASK_TTL):
+        return
+    now = time.time()
+    GENERATION_DURATION.observe(now - task_status.timestamp, task_status.workflow, task_status.status)
+    if task_status.dispatched_at:
+        tracer.record(task_status.trace_id, "balancer.execute", task_status.dispatched_at, now,
+                      node=task_status.node, status=task_status.status)
+    tracer.record(task_status.trace_id, "balancer.total", task_status.timestamp, now, status=task_status.status)
+    async with pipeline() as pipe:
+        pipe.delete(f"{global_config.JOB_DATA_KEY}{task_status.task_id}")
+        if task_status.prompt_id:
+            pipe.set(f"{global_config.PROMPT_INDEX_KEY}{task_status.prompt_id}", task_status.queue_item().json(),
+                     ex=global_config.TASK_TTL)
+        await pipe.execute()
+    await result_cache.store(task_status)
+    await admission.release(task_status)
+
+
+event_hub = TaskEventHub()
@@ -1,11 +1,15 @@
+import hashlib
+import json
+import time
 from datetime import datetime, timedelta, UTC
+from typing import Dict, List, Tuple
 
 import jwt
 from fastapi import FastAPI, Depends, HTTPException, status, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html, get_redoc_html
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
 import config as global_config
@@ -28,6 +32,35 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return encoded_jwt
 
 
+# 已验证的 token: sha256(token) -> (用户名, 缓存失效时间)
+_verified_tokens: Dict[bytes, Tuple[str, float]] = {}
+
+
+def verify_token(token: str) -> str:
+    """校验 token 并返回用户名，验证结果按 token 摘要缓存，失效时间不晚于 token 的 exp"""
+    digest = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    cached = _verified_tokens.get(digest)
+    if cached is not None:
+        if cached[1] > now:
+            return cached[0]
+        _verified_tokens.pop(digest, None)
+
+    payload = jwt.decode(token, global_config.JWT_SECRET, algorithms=[global_config.JWT_ALGORITHM])
+    username = payload.get("sub")
+    if username is None:
+        raise jwt.InvalidTokenError("token has no subject")
+    expires_at = min(payload.get("exp", now), now + global_config.JWT_CACHE_TTL)
+    if len(_verified_tokens) >= global_config.JWT_CACHE_MAX:
+        for key in [k for k, (_, exp) in _verified_tokens.items() if exp <= now]:
+            _verified_tokens.pop(key, None)
+        while len(_verified_tokens) >= global_config.JWT_CACHE_MAX:
+            # 仍然满时淘汰最早写入的
+            _verified_tokens.pop(next(iter(_verified_tokens)))
+    _verified_tokens[digest] = (username, expires_at)
+    return username
+
+
 async def get_current_user(request: Request):
     """验证JWT token"""
     credentials_exception = HTTPException(
@@ -41,11 +74,7 @@ async def get_current_user(request: Request):
             raise credentials_exception
 
         try:
-            payload = jwt.decode(token, global_config.JWT_SECRET, algorithms=[global_config.JWT_ALGORITHM])
-            username: str = payload.get("sub")
-            if username is None:
-                raise credentials_exception
-            return username
+            return verify_token(token)
         except jwt.InvalidTokenError as e:
             logger.error(f"JWT解码失败: {str(e)}")
             raise credentials_exception
@@ -204,15 +233,28 @@ def create_app(app) -> FastAPI:
             "expires_in": global_config.JWT_EXPIRE_MINUTES * 60
         }
 
+    # 路由注册完成后文档不再变化，首次请求时生成并序列化一次
+    openapi_cache: List[Tuple[bytes, str]] = []
+
+    def openapi_document() -> Tuple[bytes, str]:
+        if not openapi_cache:
+            body = json.dumps(get_openapi(
+                title=app.title,
+                version=app.version,
+                description=app.description,
+                routes=app.routes
+            ), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            openapi_cache.append((body, f'"{hashlib.sha256(body).hexdigest()[:32]}"'))
+        return openapi_cache[0]
+
     @app.get("/openapi.json", dependencies=[Depends(get_current_user)], include_in_schema=False)
-    async def get_open_api_endpoint():
-        """获取OpenAPI架构"""
-        return JSONResponse(get_openapi(
-            title=app.title,
-            version=app.version,
-            description=app.description,
-            routes=app.routes
-        ))
+    async def get_open_api_endpoint(request: Request):
+        """获取OpenAPI架构，支持 If-None-Match 协商缓存"""
+        body, etag = openapi_document()
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
 
     @app.get(global_config.SWAGGER_URL, dependencies=[Depends(get_current_user)], include_in_schema=False)
     async def get_swagger_ui():
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+
+import config as global_config
+import http_client
+from logger import app_logger as logger
+from node_registry import registry
+
+
+
+class WorkflowCatalog:
+    """
+        balancer 侧的工作流目录
+        从任一健康节点拉取工作流的 API 图与参数声明并短期缓存，
+        用于在分发前得到请求对应的完整 prompt 图；
+        同一工作流的并发查询只拉取一次，不存在或拉取失败的结果短期缓存
+    """
+
+    def __init__(self):
+        self.entries: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    async def get(self, workflow_name: str) -> Optional[Dict[str, Any]]:
+        cached = self.entries.get(workflow_name)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        future = self.pending.get(workflow_name)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.pending[workflow_name] = asyncio.get_running_loop().create_future()
+        try:
+            entry = await self._fetch(workflow_name)
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有等待者时避免 "exception was never retrieved" 告警
+            future.exception()
+            raise
+        finally:
+            self.pending.pop(workflow_name, None)
+
+    async def _fetch(self, workflow_name: str) -> Optional[Dict[str, Any]]:
+        nodes = registry.get_available_nodes()
+        if not nodes:
+            return None
+        node = nodes[0]
+        url = f"http://{node.host}:{node.port}/api/workflow/{workflow_name}/api"
+        entry = None
+        try:
+            response = await http_client.get_client().get(url)
+            if response.status_code == 200:
+                entry = orjson.loads(response.content)
+        except Exception as e:
+            logger.error(f"Error fetching workflow {workflow_name} from {node.key}: {e}")
+        ttl = global_config.WORKFLOW_CATALOG_TTL if entry is not None else global_config.WORKFLOW_CATALOG_MISS_TTL
+        now = time.time()
+        if len(self.entries) >= 1024:
+            # 未知工作流名也会被缓存，定期清掉过期的记录
+            self.entries = {name: cached for name, cached in self.entries.items() if cached[0] > now}
+        self.entries[workflow_name] = (now + ttl, entry)
+        return entry
+
+    async def preload(self, datas: Iterable[dict]):
+        """批量请求先把涉及的工作流各拉取一次，之后逐个请求的解析都命中缓存"""
+        names = {data.get("workflow_name") for data in datas if isinstance(data.get("workflow_name"), str)}
+        await asyncio.gather(*(self.get(name) for name in names))
+
+    async def resolve(self, data: dict) -> Optional[Dict[str, Any]]:
+        """按请求参数得到完整的 prompt 图，工作流或参数无法识别时返回 None(交给节点报错)"""
+        workflow_name = data.get("workflow_name")
+        if not workflow_name:
+            return None
+        entry = await self.get(workflow_name)
+        if entry is None:
+            return None
+        graph, inputs = entry["graph"], entry["inputs"]
+        values = dict(data.get("inputs") or {})
+        if data.get("prompt") is not None:
+            values.setdefault("prompt", data["prompt"])
+        patched: Dict[str, Dict[str, Any]] = {}
+        for key, value in values.items():
+            spec = inputs.get(key)
+            if spec is None or spec.get("node") not in graph:
+                return None
+            node = patched.get(spec["node"])
+            if node is None:
+                base = graph[spec["node"]]
+                node = patched[spec["node"]] = {**base, "inputs": dict(base["inputs"])}
+            node["inputs"][spec["input"]] = value
+        return {**graph, **patched} if patched else graph
+
+    async def models(self, data: dict) -> List[str]:
+        """
+            请求用到的模型文件，按 service 发布的模型描述计算(固定模型 + 模型参数的取值)，
+            与 service 侧 Loader 节点的识别规则保持一致；无法识别时返回空列表
+        """
+        workflow_name = data.get("workflow_name")
+        entry = await self.get(workflow_name) if workflow_name else None
+        spec = entry.get("models") if entry is not None else None
+        if not spec:
+            return []
+        values = data.get("inputs") or {}
+        models = set(spec["fixed"])
+        for key, default in spec["inputs"].items():
+            value = values.get(key, default)
+            if isinstance(value, str):
+                models.add(value)
+        return sorted(models)
+
+
+def graph_hash(graph: Dict[str, Any]) -> str:
+    """prompt 图的规范化哈希: 忽略 _meta 等展示信息，键排序后取 sha256"""
+    canonical = {node_id: {"class_type": node.get("class_type"), "inputs": node.get("inputs", {})}
+                 for node_id, node in graph.items()}
+    return hashlib.sha256(orjson.dumps(canonical, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+workflow_catalog = WorkflowCatalog()
@@ -1,107 +1,252 @@
-import os
+import asyncio
 import traceback
-import uuid
 
-import httpx
 import orjson
-from fastapi import APIRouter, HTTPException
+from typing import Optional
 
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+import comfy_client
 import config as global_config
-import paths
 from logger import app_logger as logger
-from models import GenerateRequest, GenerateResponse, PromptRequest, PromptResponse
+from models import GenerateRequest, GenerateResponse
+from health_check import sampler
+from image_transcode import transcoder
+from prompt_coalescer import coalescer
+from prompt_validator import prompt_validator
+from task_tracker import task_tracker
+from tracing import tracer
+from workflow_registry import WorkflowLoadError, build_prompt_body, workflow_registry
+
+
+# 转发图片时回传给调用方的响应头
+IMAGE_HEADERS = ("content-type", "content-length", "content-range", "accept-ranges", "etag", "last-modified",
+                 "content-disposition")
+
+
+async def load_workflow(name: str):
+    """获取工作流，文件不合法时返回 500 并说明原因"""
+    try:
+        return await workflow_registry.get(name)
+    except WorkflowLoadError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 def create_router() -> APIRouter:
     """Create Comfy API router"""
     router = APIRouter(prefix="/api", tags=["Comfy API"])
 
-    def get_host():
-        return global_config.COMFY_HOST
-
     @router.get("/node/status", name="Get the status of the current node")
     async def comfy_status():
-        url = f"{get_host()}/system_stats"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            return response.json()
+        response = await comfy_client.get_client().get("/system_stats")
+        return response.json()
 
     @router.get("/node/history", name="Get the history of the current node")
     async def comfy_history(isShowDetail: bool = True):
-        url = f"{get_host()}/history"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            if not isShowDetail:
-                historyIds = [history for history in response.json().keys()]
-                return historyIds
-            return response.json()
+        response = await comfy_client.get_client().get("/history")
+        if not isShowDetail:
+            historyIds = [history for history in response.json().keys()]
+            return historyIds
+        return response.json()
 
     @router.get("/node/stop", name="Stop the current workflow")
     async def stop_all():
-        url = f"{get_host()}/interrupt"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            return response.json()
+        response = await comfy_client.get_client().get("/interrupt")
+        return response.json()
 
     @router.get("/node/view", name="View the current workflow")
     async def view_image(task_id: str):
-        url = f"{get_host()}/history/{task_id}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            return response.json()
+        response = await comfy_client.get_client().get(f"/history/{task_id}")
+        return response.json()
 
     @router.get("/task/{task_id}", name="Get the status of the task")
     async def get_task_status(task_id: str):
-        url = f"{get_host()}/history/{task_id}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            res_json = response.json()
-            if response.status_code == 200 and res_json == {}:
-                return PromptResponse(status="pending", message="Task has been uncompleted.")
-            elif response.status_code == 200 and res_json != {}:
-                result = res_json[task_id]
-                images = next(iter(result['outputs'].values()))['images']
-                return PromptResponse(status="success", message="Task has been completed.", images=images)
-            else:
-                return {"status": "error", "message": "Task has been failed."}
+        # websocket 在线时已登记的任务直接本地应答，否则回退到 /history 查询
+        state = task_tracker.get(task_id)
+        if state is not None and (state.done or task_tracker.connected):
+            return state.to_response()
+        try:
+            state = await task_tracker.refresh(task_id)
+        except Exception as e:
+            logger.error(f"query task {task_id} failed: {e}")
+            return {"status": "error", "message": "Task has been failed."}
+        return state.to_response()
 
-    @router.post("/generate", name="Generate image")
-    async def generate(request: GenerateRequest) -> GenerateResponse:
+    @router.get("/queue/{task_id}", name="Get the live position of the task in the ComfyUI queue")
+    async def get_queue_position(task_id: str):
         try:
-            client_id = uuid.uuid4()
-            workflow_name = request.workflow_name
-            workflow_path = paths.get_workflow_path(workflow_name + ".json")
-            workflow_api_path = paths.get_workflow_path(workflow_name + "-api.json")
+            return await task_tracker.queue_position(task_id)
+        except Exception as e:
+            logger.error(f"query queue position of {task_id} failed: {e}")
+            raise HTTPException(status_code=502, detail="query queue failed")
+
+    @router.get("/task/{task_id}/events", name="Stream the status of the task (SSE)")
+    async def task_events(task_id: str):
+        async def event_stream():
+            queue = task_tracker.subscribe(task_id)
+            try:
+                state = task_tracker.get(task_id)
+                if state is None or (not state.done and not task_tracker.connected):
+                    state = await task_tracker.refresh(task_id)
+                snapshot = state.to_response().model_dump()
+                yield f"data: {orjson.dumps(snapshot).decode()}\n\n"
+                while snapshot["status"] not in ("success", "error"):
+                    try:
+                        snapshot = await asyncio.wait_for(queue.get(), timeout=global_config.SSE_KEEPALIVE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        # websocket 断开期间收不到推送，借保活间隔回查一次
+                        if not task_tracker.connected:
+                            await task_tracker.refresh(task_id)
+                        yield ": ping\n\n"
+                        continue
+                    yield f"data: {orjson.dumps(snapshot).decode()}\n\n"
+            except Exception as e:
+                logger.error(f"stream task {task_id} failed: {e}")
+            finally:
+                task_tracker.unsubscribe(task_id, queue)
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @router.get("/task/{task_id}/images/{n}", name="Stream the n-th output image of the task")
+    async def get_task_image(task_id: str, n: int, request: Request, format: Optional[str] = None,
+                             width: Optional[int] = None):
+        # 按块转发 ComfyUI /view，Range、If-None-Match 原样透传；指定 format/width 时返回转码后的图片
+        state = task_tracker.get(task_id)
+        if state is None or not state.done:
+            try:
+                state = await task_tracker.refresh(task_id)
+            except Exception as e:
+                logger.error(f"query task {task_id} failed: {e}")
+                raise HTTPException(status_code=502, detail="query task failed")
+        if n < 0 or n >= len(state.images):
+            raise HTTPException(status_code=404, detail="image not found")
+        image = state.images[n]
+        params = {"filename": image.get("filename", ""), "subfolder": image.get("subfolder", ""),
+                  "type": image.get("type", "output")}
+        if format is not None or width is not None:
+            return await transcoded_image(image, params, format, width, request.headers.get("if-none-match"))
+        headers = {name: request.headers[name] for name in ("range", "if-none-match", "if-modified-since")
+                   if name in request.headers}
+        client = comfy_client.get_client()
+        upstream = await client.send(client.build_request("GET", "/view", params=params, headers=headers),
+                                     stream=True)
+        if upstream.status_code >= 400:
+            await upstream.aclose()
+            raise HTTPException(status_code=upstream.status_code, detail="view image failed")
+        relay = {name: upstream.headers[name] for name in IMAGE_HEADERS if name in upstream.headers}
+        return StreamingResponse(upstream.aiter_bytes(global_config.IMAGE_CHUNK_SIZE),
+                                 status_code=upstream.status_code, headers=relay,
+                                 background=BackgroundTask(upstream.aclose))
+
+    async def transcoded_image(image: dict, params: dict, fmt: Optional[str], width: Optional[int],
+                               if_none_match: Optional[str]) -> Response:
+        try:
+            variant = transcoder.params(fmt, width)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # 原图内容哈希已知且结果已缓存时不再访问 ComfyUI
+        digest = transcoder.content_hash(image)
+        data = None
+        if digest is None or transcoder.lookup(digest, variant) is None:
+            response = await comfy_client.get_client().get("/view", params=params)
+            if response.status_code >= 400:
+                raise HTTPException(status_code=response.status_code, detail="view image failed")
+            data = response.content
+            digest = transcoder.remember(image, data)
+        etag = f'"{digest[:32]}-{variant[0]}-{variant[1]}-{variant[2]}"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+        result = transcoder.lookup(digest, variant)
+        if result is None:
+            try:
+                result = await transcoder.transcode(digest, data, variant)
+            except Exception as e:
+                logger.error(f"transcode image {params['filename']} failed: {e}")
+                raise HTTPException(status_code=422, detail="transcode image failed")
+        return Response(result, media_type=f"image/{variant[0]}", headers=headers)
+
+    @router.post("/generate", name="Generate image")
+    async def generate(request: GenerateRequest,
+                       x_trace_id: Optional[str] = Header(None)) -> GenerateResponse:
+        with tracer.span(x_trace_id, "service.generate", workflow=request.workflow_name):
+            return await submit_prompt(request, x_trace_id)
 
-            if not os.path.exists(workflow_path):
+    async def submit_prompt(request: GenerateRequest, trace_id: Optional[str]) -> GenerateResponse:
+        try:
+            # 统一使用 websocket 的 client_id，ComfyUI 才会把执行事件推送过来
+            client_id = task_tracker.client_id
+            # 同一个 task_id 重复提交(balancer 重试)时直接返回，避免重复执行
+            if request.task_id and task_tracker.get(request.task_id) is not None:
+                return GenerateResponse(task_id=request.task_id)
+            with tracer.span(trace_id, "service.workflow_load"):
+                entry = await load_workflow(request.workflow_name)
+            if entry is None or entry.api_bytes is None:
                 raise HTTPException(status_code=404, detail="the workflow file not found")
-            workflow_content = orjson.loads(paths.load_content(workflow_path))
-            workflow_api_content = orjson.loads(paths.load_content(workflow_api_path))
-
-            prompt = PromptRequest(client_id=str(client_id), prompt=workflow_api_content,
-                                   extra_data={
-                                       "extra_pnginfo": {
-                                           "workflow": workflow_content
-                                       }
-                                   })
-
-            url = f"{get_host()}/prompt"
-            headers = httpx.Headers({"Content-Type": "application/json"})
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=prompt.model_dump(), headers=headers)
-                logger.debug(f"{response.json()}")
-                response_json = response.json()
-                return GenerateResponse(task_id=response_json["prompt_id"])
+
+            values = request.input_values()
+            try:
+                patched = entry.patch(values)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            # 本地按 /object_info 校验，不合法的图不提交给 ComfyUI
+            errors = prompt_validator.validate(entry.resolve(patched))
+            if errors:
+                raise HTTPException(status_code=400, detail=f"invalid prompt: {'; '.join(errors[:10])}")
+            if coalescer.enabled_for(entry, values):
+                # 与窗口内参数相同的任务合并成一个更大 batch_size 的 prompt 提交
+                task_id, coalesced = await coalescer.submit(entry, values, request.task_id, trace_id)
+                return GenerateResponse(task_id=task_id, coalesced=coalesced)
+
+            with tracer.span(trace_id, "service.render"):
+                # 工作流已在缓存中解析并序列化，这里只重新序列化被覆盖参数的节点
+                body = build_prompt_body(client_id, entry.render(patched), entry.extra_data_bytes,
+                                         request.task_id, trace_id)
+            with tracer.span(trace_id, "service.comfy_submit"):
+                response = await comfy_client.post_prompt(body)
+            logger.debug(f"{response.json()}")
+            response_json = response.json()
+            if response.status_code == 400:
+                # prompt 校验失败，属于请求错误，不应重试
+                raise HTTPException(status_code=400, detail=response_json.get("error", "invalid prompt"))
+            task_tracker.track(response_json["prompt_id"], request.workflow_name, trace_id)
+            sampler.use_models(entry.models_for(patched))
+            return GenerateResponse(task_id=response_json["prompt_id"])
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"generate image failed: {e}")
             logger.error(f"error stack: {traceback.format_exc()}")
             raise HTTPException(status_code=500, detail="generate image failed")
 
+    @router.get("/trace/{trace_id}", name="Get the spans recorded on this node for a trace")
+    async def get_trace(trace_id: str):
+        return {"trace_id": trace_id, "spans": tracer.get(trace_id)}
+
     @router.get("/workflow/{workflow_name}", name="Get the workflow data")
     async def get_workflow(workflow_name: str):
-        workflow_path = paths.get_workflow_path(workflow_name + ".json")
-        if not os.path.exists(workflow_path):
+        entry = await load_workflow(workflow_name)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="the workflow file not found")
+        return Response(content=entry.workflow_bytes, media_type="application/json")
+
+    @router.get("/workflow/{workflow_name}/api", name="Get the api graph and inputs of the workflow")
+    async def get_workflow_api(workflow_name: str):
+        entry = await load_workflow(workflow_name)
+        if entry is None or entry.api_bytes is None:
+            raise HTTPException(status_code=404, detail="the workflow file not found")
+        return Response(content=b'{"graph":' + entry.api_bytes + b',"inputs":' + orjson.dumps(entry.inputs)
+                        + b',"models":' + orjson.dumps(entry.model_spec) + b'}',
+                        media_type="application/json")
+
+    @router.get("/workflow/{workflow_name}/inputs", name="Get the overridable inputs of the workflow")
+    async def get_workflow_inputs(workflow_name: str):
+        entry = await load_workflow(workflow_name)
+        if entry is None:
             raise HTTPException(status_code=404, detail="the workflow file not found")
-        return orjson.loads(paths.load_content(workflow_path))
+        return entry.inputs
 
     return router
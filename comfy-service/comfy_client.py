@@ -0,0 +1,67 @@
+import time
+from typing import Optional
+
+import httpx
+
+import config as global_config
+from metrics import COMFY_REQUEST_DURATION, path_label
+
+# 应用级共享的 ComfyUI 客户端，随 lifespan 创建和关闭
+_client: Optional[httpx.AsyncClient] = None
+
+
+def route_timeout(read: float) -> httpx.Timeout:
+    """按路由构造超时，连接超时统一"""
+    return httpx.Timeout(read, connect=global_config.COMFY_CONNECT_TIMEOUT)
+
+
+PROMPT_TIMEOUT = route_timeout(global_config.COMFY_PROMPT_TIMEOUT)
+QUERY_TIMEOUT = route_timeout(global_config.COMFY_QUERY_TIMEOUT)
+
+
+class TimedTransport(httpx.AsyncHTTPTransport):
+    """记录每个 ComfyUI 请求到收到响应头的耗时，连接失败记为 error"""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await super().handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            COMFY_REQUEST_DURATION.observe(time.perf_counter() - start, path_label(request.url.path), status)
+
+
+async def start():
+    global _client
+    _client = httpx.AsyncClient(
+        base_url=global_config.COMFY_HOST,
+        transport=TimedTransport(
+            limits=httpx.Limits(
+                max_connections=global_config.COMFY_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=global_config.COMFY_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=global_config.COMFY_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        ),
+        timeout=QUERY_TIMEOUT,
+    )
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("comfy client is not started")
+    return _client
+
+
+async def post_prompt(body: bytes) -> httpx.Response:
+    """提交已序列化好的 /prompt 请求体"""
+    return await get_client().post("/prompt", content=body, headers={"Content-Type": "application/json"},
+                                   timeout=PROMPT_TIMEOUT)
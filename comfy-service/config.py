@@ -22,12 +22,17 @@ API_PASSWORD = os.getenv("API_PASSWORD")
 JWT_SECRET = os.getenv("JWT_SECRET", "test-dev-secret-key")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRE_MINUTES = 3000
+# 已验证 token 缓存条数，缓存时间不超过 token 的过期时间
+JWT_CACHE_MAX = int(os.getenv("JWT_CACHE_MAX", 1024))
+JWT_CACHE_TTL = int(os.getenv("JWT_CACHE_TTL", 300))
 
 # Redis配置
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+# 连接池大小，所有请求处理协程共享
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
 
 # 服务配置
 SERVICE_HOST = os.getenv("SERVICE_HOST", "localhost")
@@ -37,3 +42,69 @@ SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8101))
 LOGDY_SERVER = os.getenv("LOGDY_SERVER", "logdy")
 LOGDY_PORT = int(os.getenv("LOGDY_PORT", 10800))
 LOGDY_API_KEY = os.getenv("LOGDY_API_KEY", "mypassword")
+# 日志发送缓冲区行数、每批行数、发送间隔(秒)
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", 10000))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 200))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 0.5))
+
+# 节点心跳配置
+NODE_EVENTS_CHANNEL = "comfy:node:events"
+
+# ComfyUI HTTP连接池配置
+COMFY_HTTP_MAX_CONNECTIONS = int(os.getenv("COMFY_HTTP_MAX_CONNECTIONS", 100))
+COMFY_HTTP_MAX_KEEPALIVE = int(os.getenv("COMFY_HTTP_MAX_KEEPALIVE", 20))
+COMFY_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("COMFY_HTTP_KEEPALIVE_EXPIRY", 30))
+COMFY_CONNECT_TIMEOUT = float(os.getenv("COMFY_CONNECT_TIMEOUT", 3))
+# 各路由读超时(秒)
+COMFY_PROMPT_TIMEOUT = float(os.getenv("COMFY_PROMPT_TIMEOUT", 30))
+COMFY_QUERY_TIMEOUT = float(os.getenv("COMFY_QUERY_TIMEOUT", 10))
+# 节点权重，加权轮询策略使用
+NODE_WEIGHT = int(os.getenv("NODE_WEIGHT", 1))
+
+# 任务状态内存表容量
+TASK_TRACKER_MAX_TASKS = int(os.getenv("TASK_TRACKER_MAX_TASKS", 10000))
+# SSE 保活间隔(秒)
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", 15))
+# ComfyUI /queue 查询结果的缓存时间(秒)，用于报告任务排队位置
+QUEUE_POSITION_TTL = float(os.getenv("QUEUE_POSITION_TTL", 1))
+
+# 工作流缓存: 最多缓存的工作流数量、文件变更检查间隔(秒)
+WORKFLOW_CACHE_SIZE = int(os.getenv("WORKFLOW_CACHE_SIZE", 64))
+WORKFLOW_WATCH_INTERVAL = float(os.getenv("WORKFLOW_WATCH_INTERVAL", 2))
+
+# 心跳: 空闲/忙碌时的发送间隔、CPU 采样间隔与滑动窗口、GPU 采样间隔(秒)
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 5))
+HEARTBEAT_MIN_INTERVAL = float(os.getenv("HEARTBEAT_MIN_INTERVAL", 1))
+CPU_SAMPLE_INTERVAL = float(os.getenv("CPU_SAMPLE_INTERVAL", 1))
+CPU_SAMPLE_WINDOW = int(os.getenv("CPU_SAMPLE_WINDOW", 10))
+GPU_SAMPLE_INTERVAL = float(os.getenv("GPU_SAMPLE_INTERVAL", 15))
+
+# 链路追踪: 内存中保留的 trace 数，TRACE_FILE 非空时同时导出为 JSONL
+TRACE_MAX_TRACES = int(os.getenv("TRACE_MAX_TRACES", 2000))
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+# 图片流式转发的分块大小(字节)
+IMAGE_CHUNK_SIZE = int(os.getenv("IMAGE_CHUNK_SIZE", 64 * 1024))
+# 缩略图/格式转换: 进程数、最大宽度、编码质量、结果缓存上限
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", min(4, os.cpu_count() or 1)))
+TRANSCODE_MAX_WIDTH = int(os.getenv("TRANSCODE_MAX_WIDTH", 4096))
+TRANSCODE_QUALITY = int(os.getenv("TRANSCODE_QUALITY", 80))
+TRANSCODE_CACHE_MAX_BYTES = int(os.getenv("TRANSCODE_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+TRANSCODE_CACHE_MAX_ENTRIES = int(os.getenv("TRANSCODE_CACHE_MAX_ENTRIES", 10000))
+
+# 心跳上报最近使用的模型: 最多条数、多久未使用后不再上报(秒)
+MODEL_RECENT_MAX = int(os.getenv("MODEL_RECENT_MAX", 8))
+MODEL_RECENT_TTL = float(os.getenv("MODEL_RECENT_TTL", 1800))
+
+# 合并提交: 窗口内同一工作流、除 seed/batch_size 外参数相同的任务合并成一个更大 batch_size 的 prompt
+# 合并后整批共用第一个任务的 seed，图片与单独提交时不同，因此默认关闭(窗口为 0)
+COALESCE_WINDOW_MS = float(os.getenv("COALESCE_WINDOW_MS", 0))
+COALESCE_MAX_BATCH = int(os.getenv("COALESCE_MAX_BATCH", 4))
+# 允许合并的工作流，逗号分隔；须声明 batch_size 参数且每个输出节点的图片数随 batch_size 增长，为空则不合并
+COALESCE_WORKFLOWS = {name for name in os.getenv("COALESCE_WORKFLOWS", "").split(",") if name}
+
+# 提交前按 ComfyUI /object_info 在本地校验 prompt 图
+PROMPT_VALIDATION = os.getenv("PROMPT_VALIDATION", "true").lower() == "true"
+# /object_info 缓存的有效期(秒)，ComfyUI 重连(通常是重启)后也会重新拉取；以及检查间隔
+OBJECT_INFO_TTL = float(os.getenv("OBJECT_INFO_TTL", 600))
+OBJECT_INFO_CHECK_INTERVAL = float(os.getenv("OBJECT_INFO_CHECK_INTERVAL", 5))
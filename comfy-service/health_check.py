@@ -1,67 +1,184 @@
-import os
+import asyncio
 import time
 import json
+from collections import OrderedDict, deque
+from typing import List
 import psutil
-import redis
-import threading
 import GPUtil
+import comfy_client
 import config as global_config
+import redis_store
 from logger import app_logger as logger
 
-redis_client = redis.Redis(
-    host=global_config.REDIS_HOST,
-    port=global_config.REDIS_PORT,
-    db=global_config.REDIS_DB,
-    password=global_config.REDIS_PASSWORD,
-    decode_responses=True
-)
-
 NODE_STATUS_KEY = f"comfy:node:status:{global_config.SERVICE_HOST}:{global_config.SERVICE_PORT}"
 
-def get_system_metrics():
-    """获取系统指标"""
+
+def get_gpu_usage() -> float:
+    """GPU使用率(GPUtil 会调用 nvidia-smi，需在线程中执行)"""
     try:
-        # CPU使用率
-        cpu_usage = psutil.cpu_percent(interval=1)
-        
-        # GPU使用率
-        gpu_usage = 0.0
-        try:
-            gpus = GPUtil.getGPUs()
-            if gpus:
-                gpu_usage = sum(gpu.load * 100 for gpu in gpus) / len(gpus)
-        except Exception as e:
-            logger.error(f"Error getting GPU metrics: {e}")
-        
+        gpus = GPUtil.getGPUs()
+        if gpus:
+            return sum(gpu.load * 100 for gpu in gpus) / len(gpus)
+    except Exception as e:
+        logger.error(f"Error getting GPU metrics: {e}")
+    return 0.0
+
+
+class HeartbeatSampler:
+    """
+        心跳采样
+        CPU 每秒非阻塞采样一次取滑动平均，GPU 低频在线程中采样，ComfyUI 队列与显存按心跳间隔读取；
+        GPU 与 ComfyUI 各自在独立任务中采样，心跳只发送最近一次的结果，不等待采样
+    """
+
+    def __init__(self):
+        self.cpu_samples = deque(maxlen=global_config.CPU_SAMPLE_WINDOW)
+        self.gpu_usage = 0.0
+        self.gpu_sampled_at = 0.0
+        self.queue_remaining = 0
+        self.running = 0
+        self.vram_free = 0
+        # 本服务正在处理的请求数，由 main 中的中间件维护
+        self.inflight = 0
+        self.comfy_online = True
+        # 最近一次 ComfyUI 可达性变化的时间，用于判断抖动
+        self.flapped_at = 0.0
+        self.interval = global_config.HEARTBEAT_INTERVAL
+        # 最近使用的模型 -> 最后使用时间，ComfyUI 不提供已加载模型的接口，以最近使用近似
+        self.models: "OrderedDict[str, float]" = OrderedDict()
+        psutil.cpu_percent(interval=None)
+
+    def sample_cpu(self):
+        # interval=None 直接返回距上次调用的平均值，不阻塞
+        self.cpu_samples.append(psutil.cpu_percent(interval=None))
+
+    async def sample_gpu(self):
+        if time.time() - self.gpu_sampled_at >= global_config.GPU_SAMPLE_INTERVAL:
+            self.gpu_sampled_at = time.time()
+            self.gpu_usage = await asyncio.to_thread(get_gpu_usage)
+
+    async def sample_comfy(self):
+        """读取 ComfyUI 队列和显存"""
+        client = comfy_client.get_client()
+        queue, stats = await asyncio.gather(client.get("/queue"), client.get("/system_stats"),
+                                            return_exceptions=True)
+        online = not isinstance(queue, Exception)
+        if online != self.comfy_online:
+            self.comfy_online = online
+            self.flapped_at = time.time()
+        if isinstance(queue, Exception):
+            logger.error(f"Error getting ComfyUI queue: {queue}")
+        else:
+            queue_json = queue.json()
+            self.running = len(queue_json.get("queue_running", []))
+            self.queue_remaining = self.running + len(queue_json.get("queue_pending", []))
+        if isinstance(stats, Exception):
+            logger.error(f"Error getting ComfyUI system stats: {stats}")
+        else:
+            self.vram_free = sum(device.get("vram_free", 0) for device in stats.json().get("devices", []))
+
+    def use_models(self, models: List[str]):
+        now = time.time()
+        for model in models:
+            self.models[model] = now
+            self.models.move_to_end(model)
+        while len(self.models) > global_config.MODEL_RECENT_MAX:
+            self.models.popitem(last=False)
+
+    def recent_models(self) -> List[str]:
+        expire = time.time() - global_config.MODEL_RECENT_TTL
+        return [model for model, used in self.models.items() if used >= expire]
+
+    def next_interval(self) -> float:
+        """忙碌或最近状态抖动时缩短心跳间隔，空闲时放宽"""
+        busy = self.queue_remaining > 0 or self.inflight > 0
+        flapping = time.time() - self.flapped_at < global_config.HEARTBEAT_INTERVAL * 6
+        if busy or flapping or not self.comfy_online:
+            return global_config.HEARTBEAT_MIN_INTERVAL
+        return global_config.HEARTBEAT_INTERVAL
+
+    def record(self, draining: bool = False) -> dict:
+        """心跳数据"""
+        cpu_usage = sum(self.cpu_samples) / len(self.cpu_samples) if self.cpu_samples else 0.0
         return {
             "host": global_config.SERVICE_HOST,
             "port": global_config.SERVICE_PORT,
-            "cpu_usage": cpu_usage,
-            "gpu_usage": gpu_usage,
-            "last_update": int(time.time())
+            "cpu_usage": round(cpu_usage, 1),
+            "gpu_usage": round(self.gpu_usage, 1),
+            "queue_remaining": self.queue_remaining,
+            "running": self.running,
+            "vram_free": self.vram_free,
+            "inflight": self.inflight,
+            "heartbeat_interval": self.interval,
+            "comfy_online": self.comfy_online,
+            "draining": draining,
+            "weight": global_config.NODE_WEIGHT,
+            "models": self.recent_models(),
+            "last_update": time.time()
         }
-    except Exception as e:
-        logger.error(f"Error getting system metrics: {e}")
-        return None
 
-def update_node_status():
-    """更新节点状态到Redis"""
+
+sampler = HeartbeatSampler()
+
+
+async def publish(record: dict):
+    """写状态键的同时广播给 balancer 的本地节点表，一次往返完成"""
+    payload = json.dumps(record, separators=(",", ":"))
+    async with redis_store.pipeline() as pipe:
+        pipe.set(NODE_STATUS_KEY, payload, ex=60)  # 60秒过期
+        pipe.publish(global_config.NODE_EVENTS_CHANNEL, payload)
+        await pipe.execute()
+
+
+async def sample_loop(sample, interval):
+    """独立的采样任务，慢的 nvidia-smi 或 ComfyUI 请求不会推迟心跳"""
     while True:
         try:
-            metrics = get_system_metrics()
-            if metrics:
-                redis_client.set(
-                    NODE_STATUS_KEY,
-                    json.dumps(metrics),
-                    ex=60  # 60秒过期
-                )
+            await sample()
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Error updating node status: {e}")
-        
-        time.sleep(5)  # 每10秒更新一次
-
-def start_health_check():
-    """启动健康检查线程"""
-    thread = threading.Thread(target=update_node_status, daemon=True)
-    thread.start()
-    return thread
+            logger.error(f"Error sampling node status: {e}")
+        await asyncio.sleep(interval())
+
+
+async def update_node_status():
+    """按心跳间隔把最近一次的采样结果更新到Redis"""
+    samplers = [
+        asyncio.create_task(sample_loop(sampler.sample_gpu, lambda: global_config.GPU_SAMPLE_INTERVAL)),
+        asyncio.create_task(sample_loop(sampler.sample_comfy, lambda: sampler.interval)),
+    ]
+    last_publish = 0.0
+    try:
+        while True:
+            try:
+                sampler.sample_cpu()
+                # 两次心跳之间只允许缩短间隔(如有新请求进来)，放宽要等下一次心跳告知 balancer
+                sampler.interval = min(sampler.interval, sampler.next_interval())
+                if time.time() - last_publish >= sampler.interval:
+                    last_publish = time.time()
+                    sampler.interval = sampler.next_interval()
+                    await publish(sampler.record())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error updating node status: {e}")
+
+            await asyncio.sleep(min(global_config.CPU_SAMPLE_INTERVAL, sampler.interval))
+    finally:
+        for task in samplers:
+            task.cancel()
+        await asyncio.gather(*samplers, return_exceptions=True)
+
+
+async def announce_draining():
+    """下线前广播一次，balancer 立即停止向本节点分发"""
+    try:
+        await publish(sampler.record(draining=True))
+    except Exception as e:
+        logger.error(f"Error announcing draining: {e}")
+
+
+def start_health_check() -> asyncio.Task:
+    """启动健康检查后台任务，需在事件循环内调用"""
+    return asyncio.create_task(update_node_status())
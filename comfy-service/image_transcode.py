@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import io
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+import config as global_config
+from logger import app_logger as logger
+
+# 支持的输出格式 -> Pillow 编码器名称
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG", "jpg": "JPEG", "png": "PNG"}
+
+
+def transcode(data: bytes, fmt: str, width: Optional[int], quality: int) -> bytes:
+    """在子进程中执行: 按宽度等比缩小(不放大)并重新编码"""
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        if width and width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        encoder = FORMATS[fmt]
+        if encoder == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        if encoder == "PNG":
+            image.save(out, encoder, optimize=True)
+        else:
+            image.save(out, encoder, quality=quality)
+        return out.getvalue()
+
+
+class Transcoder:
+    """
+        缩略图与格式转换
+        编码在进程池中执行，结果按 (原图内容哈希, 参数) 缓存在内存中，总大小受 TRANSCODE_CACHE_MAX_BYTES 限制；
+        另记录 ComfyUI 图片描述到内容哈希的映射，命中时不再访问 /view
+    """
+
+    def __init__(self):
+        self.results: "OrderedDict[Tuple[str, str, int, int], bytes]" = OrderedDict()
+        self.size = 0
+        self.hashes: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+        self.pending: Dict[Tuple[str, str, int, int], asyncio.Future] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @staticmethod
+    def params(fmt: Optional[str], width: Optional[int]) -> Tuple[str, int, int]:
+        """校验并归一参数，非法时抛出 ValueError"""
+        fmt = (fmt or "webp").lower()
+        if fmt not in FORMATS:
+            raise ValueError(f"unsupported format: {fmt}")
+        if fmt == "jpg":
+            fmt = "jpeg"
+        # 不传 width 表示保持原尺寸，内部记为 0
+        if width is not None and not 1 <= width <= global_config.TRANSCODE_MAX_WIDTH:
+            raise ValueError(f"width must be between 1 and {global_config.TRANSCODE_MAX_WIDTH}")
+        return fmt, width or 0, global_config.TRANSCODE_QUALITY
+
+    @staticmethod
+    def image_key(image: Dict[str, str]) -> Tuple[str, str, str]:
+        return image.get("type", "output"), image.get("subfolder", ""), image.get("filename", "")
+
+    def content_hash(self, image: Dict[str, str]) -> Optional[str]:
+        return self.hashes.get(self.image_key(image))
+
+    def remember(self, image: Dict[str, str], data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        self.hashes[self.image_key(image)] = digest
+        while len(self.hashes) > global_config.TRANSCODE_CACHE_MAX_ENTRIES:
+            self.hashes.popitem(last=False)
+        return digest
+
+    def lookup(self, digest: str, params: Tuple[str, int, int]) -> Optional[bytes]:
+        key = (digest, *params)
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+        return result
+
+    def _store(self, key: Tuple[str, str, int, int], result: bytes):
+        self.results[key] = result
+        self.size += len(result)
+        while self.size > global_config.TRANSCODE_CACHE_MAX_BYTES and len(self.results) > 1:
+            _, evicted = self.results.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn 避免 fork 带上事件循环和后台线程的状态
+            self._executor = ProcessPoolExecutor(max_workers=global_config.TRANSCODE_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def transcode(self, digest: str, data: bytes, params: Tuple[str, int, int]) -> bytes:
+        """同一原图同一参数的并发请求只编码一次"""
+        key = (digest, *params)
+        result = self.lookup(digest, params)
+        if result is not None:
+            return result
+        future = self.pending.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._pool(), transcode, data, *params)
+            self._store(key, result)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有并发等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self.pending.pop(key, None)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            logger.info("图片转码进程池已关闭")
+
+
+transcoder = Transcoder()
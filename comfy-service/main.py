@@ -1,10 +1,22 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 import uvicorn
 from logger import Logger, app_logger as logger
 import config as global_config
 from web import create_app
 from comfy_api import create_router
-from health_check import start_health_check
+from health_check import announce_draining, sampler, start_health_check
 import paths
+import metrics
+import redis_store
+import comfy_client
+from image_transcode import transcoder
+from prompt_coalescer import coalescer
+from prompt_validator import prompt_validator
+from task_tracker import task_tracker
+from tracing import tracer
+from workflow_registry import workflow_registry
 
 from fastapi import FastAPI, Depends, HTTPException, status, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -13,6 +25,30 @@ from fastapi.openapi.utils import get_openapi
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await comfy_client.start()
+    await task_tracker.start()
+    await workflow_registry.start()
+    await prompt_validator.start()
+    await tracer.start()
+    # 启动健康检查
+    health_task = start_health_check()
+    logger.info("健康检查服务已启动")
+    yield
+    health_task.cancel()
+    await announce_draining()
+    await asyncio.gather(health_task, return_exceptions=True)
+    await coalescer.stop()
+    await task_tracker.stop()
+    await workflow_registry.stop()
+    await prompt_validator.stop()
+    await tracer.stop()
+    transcoder.stop()
+    await redis_store.close()
+    await comfy_client.close()
+
+
 def main():
     Logger.setup(False)
 
@@ -22,7 +58,10 @@ def main():
         description="DevComfy",
         version="1.0.0",
         docs_url=None,
-        redoc_url=None
+        redoc_url=None,
+        # /openapi.json 由 web.create_app 注册(需登录并带缓存)
+        openapi_url=None,
+        lifespan=lifespan
     )
 
     # 添加CORS中间件
@@ -33,6 +72,19 @@ def main():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # 按路由记录请求耗时
+    app.middleware("http")(metrics.track_request)
+    app.add_api_route("/metrics", metrics.metrics_endpoint, methods=["GET"], include_in_schema=False)
+
+    # 统计正在处理的请求数，随心跳上报
+    @app.middleware("http")
+    async def count_inflight(request: Request, call_next):
+        sampler.inflight += 1
+        try:
+            return await call_next(request)
+        finally:
+            sampler.inflight -= 1
+
     # 初始化日志
     Logger.setup(False)
     
@@ -42,10 +94,6 @@ def main():
     # 添加comfy_api路由
     app.include_router(create_router())
     
-    # 启动健康检查
-    start_health_check()
-    logger.info("健康检查服务已启动")
-    
     # 启动服务
     logger.info(f"启动服务: {global_config.SERVICE_PORT}")
     logger.info(f"项目目录: {paths.get_app_dir()}")
@@ -0,0 +1,120 @@
+import time
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+# 默认延迟分桶(秒)，覆盖 Redis 往返到整图生成
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """计数器，只在事件循环线程中更新，无需加锁；name 需带 _total 后缀，HELP/TYPE 与样本同名"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+        直方图，记录时只做一次二分查找和两次加法，
+        累计分桶在导出时再计算
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [各分桶计数..., +Inf 计数, 总和]
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def path_label(path: str) -> str:
+    """把 URL 路径归一为低基数标签，任务id等长段替换为 :id"""
+    parts = [":id" if len(part) >= 16 or part.isdigit() else part for part in path.strip("/").split("/")]
+    return "/" + "/".join(parts)
+
+
+HTTP_REQUEST_DURATION = Histogram("comfy_service_http_request_duration_seconds",
+                                  "Request handling time per route", ("method", "route", "status"))
+COMFY_REQUEST_DURATION = Histogram("comfy_service_comfy_request_duration_seconds",
+                                   "Time to response headers of requests to ComfyUI", ("path", "status"))
+REDIS_COMMAND_DURATION = Histogram("comfy_service_redis_command_duration_seconds",
+                                   "Redis command and pipeline round trip time", ("command",))
+COMFY_QUEUE_WAIT = Histogram("comfy_service_comfy_queue_wait_seconds",
+                             "Time from prompt submission to execution start in ComfyUI", ("workflow",))
+WORKFLOW_DURATION = Histogram("comfy_service_workflow_duration_seconds",
+                              "Time from prompt submission to completion per workflow", ("workflow", "status"))
+
+REGISTRY = (HTTP_REQUEST_DURATION, COMFY_REQUEST_DURATION, REDIS_COMMAND_DURATION,
+            COMFY_QUEUE_WAIT, WORKFLOW_DURATION)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def track_request(request: Request, call_next):
+    """HTTP 中间件: 按路由模板记录处理耗时，避免路径参数导致标签膨胀"""
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, request.method,
+                                      route.path if route is not None else "unmatched", status)
+
+
+async def metrics_endpoint() -> Response:
+    return Response(render(), media_type="text/plain; version=0.0.4")
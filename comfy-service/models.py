@@ -9,6 +9,8 @@ class Token(BaseModel):
 
 class GenerateResponse(BaseModel):
     task_id: str
+    # 与其他任务合并提交，图片不是用本任务的 seed 生成的，调用方不应缓存结果
+    coalesced: bool = False
 
 class PromptRequest(BaseModel):
     client_id: str
@@ -19,9 +21,21 @@ class PromptRequest(BaseModel):
 class PromptResponse(BaseModel):
     status:str
     message:str
-    images:Optional[List[Dict[str,Any]]]
+    images:Optional[List[Dict[str,Any]]] = None
+    progress:Optional[Dict[str,Any]] = None
     
 
 class GenerateRequest(BaseModel):
     prompt: Optional[str] = None
     workflow_name: str
+    # 工作流声明的可覆盖参数，见 workflows/<name>-inputs.json
+    inputs: Optional[Dict[str,Any]] = None
+    # 幂等键，作为 ComfyUI 的 prompt_id；由 balancer 传入任务id
+    task_id: Optional[str] = None
+
+    def input_values(self) -> Dict[str,Any]:
+        """合并 prompt 与 inputs，prompt 对应声明中名为 prompt 的参数"""
+        values = dict(self.inputs or {})
+        if self.prompt is not None:
+            values.setdefault("prompt", self.prompt)
+        return values
@@ -0,0 +1,137 @@
+import asyncio
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import orjson
+from fastapi import HTTPException
+
+import comfy_client
+import config as global_config
+from health_check import sampler
+from logger import app_logger as logger
+from task_tracker import task_tracker
+from tracing import tracer
+from workflow_registry import WorkflowEntry, build_prompt_body
+
+# 不参与分组的参数: seed 整批取第一个任务的(合并后的任务标记为 coalesced，不进入结果缓存)，batch_size 累加
+IGNORED_INPUTS = ("seed", "batch_size")
+
+
+class _Member:
+    def __init__(self, task_id: str, values: Dict[str, Any], count: int, trace_id: Optional[str]):
+        self.task_id = task_id
+        self.values = values
+        self.count = count
+        self.trace_id = trace_id
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class _Group:
+    def __init__(self, entry: WorkflowEntry):
+        self.entry = entry
+        self.members: List[_Member] = []
+        self.count = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class PromptCoalescer:
+    """
+        合并提交
+        COALESCE_WINDOW_MS 窗口内同一工作流、除 seed/batch_size 外参数相同的任务合并成一个 prompt，
+        batch_size 为各任务之和(不超过 COALESCE_MAX_BATCH)；执行结果由 task_tracker 按顺序拆回各任务
+    """
+
+    def __init__(self):
+        self.groups: Dict[Tuple[str, bytes], _Group] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def batch_size(entry: WorkflowEntry, values: Dict[str, Any]) -> int:
+        spec = entry.inputs["batch_size"]
+        return values.get("batch_size", entry.api_graph[spec["node"]]["inputs"][spec["input"]])
+
+    def enabled_for(self, entry: WorkflowEntry, values: Dict[str, Any]) -> bool:
+        # 只合并明确配置的工作流: 其每个输出节点的图片数必须随 batch_size 增长才能拆分
+        if global_config.COALESCE_WINDOW_MS <= 0 or entry.name not in global_config.COALESCE_WORKFLOWS:
+            return False
+        if "batch_size" not in entry.inputs:
+            return False
+        count = self.batch_size(entry, values)
+        return isinstance(count, int) and 0 < count < global_config.COALESCE_MAX_BATCH
+
+    async def submit(self, entry: WorkflowEntry, values: Dict[str, Any], task_id: Optional[str],
+                     trace_id: Optional[str]) -> Tuple[str, bool]:
+        """加入分组并等待整批提交完成，返回任务 id 及是否与其他任务合并；提交失败时抛出与单独提交相同的异常"""
+        key = (entry.name, orjson.dumps({k: v for k, v in values.items() if k not in IGNORED_INPUTS},
+                                        option=orjson.OPT_SORT_KEYS))
+        member = _Member(task_id or uuid.uuid4().hex, values, self.batch_size(entry, values), trace_id)
+        # 入组即登记，窗口内 balancer 的重试按重复提交处理，不会再排一次
+        task_tracker.track(member.task_id, entry.name, trace_id)
+        group = self.groups.get(key)
+        if group is not None and group.count + member.count > global_config.COALESCE_MAX_BATCH:
+            self._flush(key, group)
+            group = None
+        if group is None:
+            group = self.groups[key] = _Group(entry)
+            group.timer = asyncio.get_running_loop().call_later(global_config.COALESCE_WINDOW_MS / 1000,
+                                                                self._flush, key, group)
+        group.members.append(member)
+        group.count += member.count
+        if group.count >= global_config.COALESCE_MAX_BATCH:
+            self._flush(key, group)
+        with tracer.span(trace_id, "service.coalesce"):
+            return await asyncio.shield(member.future)
+
+    def _flush(self, key: Tuple[str, bytes], group: _Group):
+        if self.groups.get(key) is group:
+            self.groups.pop(key)
+        if group.timer is not None:
+            group.timer.cancel()
+            group.timer = None
+        task = asyncio.create_task(self._submit(group))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _submit(self, group: _Group):
+        entry, members = group.entry, group.members
+        first = members[0]
+        try:
+            patched = entry.patch({**first.values, "batch_size": group.count})
+            # 只有一个任务时按普通提交处理，prompt_id 就是任务 id
+            prompt_id = first.task_id if len(members) == 1 else uuid.uuid4().hex
+            body = build_prompt_body(task_tracker.client_id, entry.render(patched), entry.extra_data_bytes,
+                                     prompt_id, first.trace_id)
+            start = time.time()
+            response = await comfy_client.post_prompt(body)
+            for member in members:
+                tracer.record(member.trace_id, "service.comfy_submit", start, time.time(), batch=len(members))
+            response_json = response.json()
+            if response.status_code == 400:
+                raise HTTPException(status_code=400, detail=response_json.get("error", "invalid prompt"))
+            if len(members) == 1:
+                task_tracker.track(response_json["prompt_id"], entry.name, first.trace_id)
+            else:
+                task_tracker.track_batch(response_json["prompt_id"], entry.name,
+                                         [(member.task_id, member.count, member.trace_id) for member in members])
+                logger.debug(f"coalesced {len(members)} tasks into prompt {response_json['prompt_id']}")
+            sampler.use_models(entry.models_for(patched))
+            for member in members:
+                if not member.future.done():
+                    member.future.set_result((member.task_id, len(members) > 1))
+        except Exception as e:
+            for member in members:
+                task_tracker.forget(member.task_id)
+                if not member.future.done():
+                    member.future.set_exception(e)
+                    # 等待者可能已断开，避免 "exception was never retrieved" 告警
+                    member.future.exception()
+
+    async def stop(self):
+        """立即提交窗口内尚未提交的分组"""
+        for key, group in list(self.groups.items()):
+            self._flush(key, group)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+coalescer = PromptCoalescer()
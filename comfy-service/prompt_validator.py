@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, List, Optional
+
+import orjson
+
+import comfy_client
+import config as global_config
+from logger import app_logger as logger
+from task_tracker import task_tracker
+
+
+class NodeSchema:
+    """/object_info 中单个节点类型的精简描述: 输入类型(组合框为 None)、必填输入、输出类型"""
+
+    __slots__ = ("required", "inputs", "outputs", "output_node")
+
+    def __init__(self, info: Dict[str, Any]):
+        declared = info.get("input") or {}
+        required = declared.get("required") or {}
+        self.required = list(required)
+        self.inputs: Dict[str, Optional[str]] = {}
+        for group in (required, declared.get("optional") or {}):
+            for name, spec in group.items():
+                kind = spec[0] if isinstance(spec, (list, tuple)) and spec else spec
+                self.inputs[name] = kind if isinstance(kind, str) else None
+        self.outputs: List[str] = [kind if isinstance(kind, str) else "*" for kind in info.get("output") or []]
+        self.output_node = bool(info.get("output_node"))
+
+
+def compile_schema(content: bytes) -> Dict[str, NodeSchema]:
+    return {class_type: NodeSchema(info) for class_type, info in orjson.loads(content).items()}
+
+
+def is_link(value: Any) -> bool:
+    """["节点id", 输出序号] 形式的连线"""
+    return (isinstance(value, list) and len(value) == 2 and isinstance(value[0], (str, int))
+            and isinstance(value[1], int) and not isinstance(value[1], bool))
+
+
+def types_match(expected: Optional[str], received: str) -> bool:
+    """与 ComfyUI 一致: * 匹配任意类型，逗号分隔的类型有交集即可"""
+    if expected is None or expected == "*" or received == "*":
+        return True
+    return bool(set(expected.split(",")) & set(received.split(",")))
+
+
+def find_cycle(edges: Dict[str, List[str]]) -> Optional[List[str]]:
+    """在 节点 -> 上游节点 的连线图中找一个环，返回环上的节点，无环返回 None"""
+    visiting, finished = set(), set()
+    for root in edges:
+        if root in finished:
+            continue
+        path = [root]
+        stack = [iter(edges.get(root, ()))]
+        visiting.add(root)
+        while stack:
+            upstream = next(stack[-1], None)
+            if upstream is None:
+                node = path.pop()
+                stack.pop()
+                visiting.discard(node)
+                finished.add(node)
+            elif upstream in visiting:
+                return path[path.index(upstream):] + [upstream]
+            elif upstream not in finished:
+                visiting.add(upstream)
+                path.append(upstream)
+                stack.append(iter(edges.get(upstream, ())))
+    return None
+
+
+class PromptValidator:
+    """
+        提交前在本地校验 prompt 图，不合法的请求不再占用 ComfyUI 的往返和队列
+        检查节点类型、必填输入、连线目标与输出序号及类型、环；
+        /object_info 按 OBJECT_INFO_TTL 定期拉取，websocket 重连(ComfyUI 重启)后立即重新拉取，内容不变时不重复解析
+    """
+
+    def __init__(self):
+        self.schema: Optional[Dict[str, NodeSchema]] = None
+        self.digest: Optional[str] = None
+        self.checked_at = 0.0
+        self.connections = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self):
+        self.checked_at = time.time()
+        self.connections = task_tracker.connections
+        try:
+            response = await comfy_client.get_client().get("/object_info", timeout=comfy_client.PROMPT_TIMEOUT)
+            response.raise_for_status()
+            digest = hashlib.sha256(response.content).hexdigest()
+            if digest == self.digest:
+                return
+            self.schema = await asyncio.to_thread(compile_schema, response.content)
+            self.digest = digest
+            logger.info(f"已加载 ComfyUI /object_info: {len(self.schema)} 个节点类型")
+        except Exception as e:
+            # 拉取失败时沿用旧的描述，从未拉取成功则不做校验
+            logger.warning(f"fetch /object_info failed: {e}")
+
+    def validate(self, graph: Dict[str, Any]) -> List[str]:
+        """返回错误列表，空列表表示通过(或尚无 /object_info 可用)"""
+        if self.schema is None:
+            return []
+        errors = []
+        edges: Dict[str, List[str]] = {}
+        has_output = False
+        for node_id, node in graph.items():
+            if not isinstance(node, dict) or not isinstance(node.get("inputs", {}), dict):
+                errors.append(f"node {node_id}: malformed node")
+                continue
+            class_type = node.get("class_type")
+            schema = self.schema.get(class_type)
+            if schema is None:
+                errors.append(f"node {node_id}: unknown class_type {class_type!r}")
+                continue
+            has_output = has_output or schema.output_node
+            inputs = node.get("inputs", {})
+            for name in schema.required:
+                if name not in inputs:
+                    errors.append(f"node {node_id} ({class_type}): missing required input {name!r}")
+            for name, value in inputs.items():
+                if not is_link(value):
+                    continue
+                source_id, index = str(value[0]), value[1]
+                source = graph.get(source_id)
+                if source is None:
+                    errors.append(f"node {node_id} ({class_type}): input {name!r} links to missing node {source_id}")
+                    continue
+                edges.setdefault(node_id, []).append(source_id)
+                source_schema = self.schema.get(source.get("class_type")) if isinstance(source, dict) else None
+                if source_schema is None:
+                    # 上游节点自身的错误会单独报告
+                    continue
+                if not 0 <= index < len(source_schema.outputs):
+                    errors.append(f"node {node_id} ({class_type}): input {name!r} links to output {index} of "
+                                  f"node {source_id}, which has {len(source_schema.outputs)} outputs")
+                elif not types_match(schema.inputs.get(name), source_schema.outputs[index]):
+                    errors.append(f"node {node_id} ({class_type}): input {name!r} expects "
+                                  f"{schema.inputs.get(name)}, node {source_id} output {index} is "
+                                  f"{source_schema.outputs[index]}")
+        if not has_output and not errors:
+            errors.append("prompt has no output node")
+        cycle = find_cycle(edges)
+        if cycle:
+            errors.append(f"cycle between nodes: {' -> '.join(cycle)}")
+        return errors
+
+    async def _watch(self):
+        while True:
+            try:
+                reconnected = task_tracker.connected and task_tracker.connections != self.connections
+                if reconnected or time.time() - self.checked_at > global_config.OBJECT_INFO_TTL:
+                    await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing /object_info: {e}")
+            await asyncio.sleep(global_config.OBJECT_INFO_CHECK_INTERVAL)
+
+    async def start(self):
+        if global_config.PROMPT_VALIDATION:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+prompt_validator = PromptValidator()
@@ -0,0 +1,55 @@
+import time
+
+import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
+
+import config as global_config
+from metrics import REDIS_COMMAND_DURATION
+
+# 全局异步连接池，请求处理中的 Redis 往返不再阻塞事件循环
+# 连接耗尽时排队等待而不是直接报错
+pool = aioredis.BlockingConnectionPool(
+    host=global_config.REDIS_HOST,
+    port=global_config.REDIS_PORT,
+    db=global_config.REDIS_DB,
+    password=global_config.REDIS_PASSWORD,
+    max_connections=global_config.REDIS_MAX_CONNECTIONS,
+    timeout=5,
+    decode_responses=True
+)
+
+
+
+class TimedRedis(aioredis.Redis):
+    """按命令记录往返耗时"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - start, str(args[0]).upper())
+
+
+class TimedPipeline(Pipeline):
+    """管道整体记为一次往返"""
+
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - start, "PIPELINE")
+
+
+redis_client = TimedRedis(connection_pool=pool)
+
+
+def pipeline(transaction: bool = False):
+    """获取管道，多条命令一次往返提交"""
+    return TimedPipeline(redis_client.connection_pool, redis_client.response_callbacks, transaction, None)
+
+
+async def close():
+    """关闭连接池"""
+    await pool.disconnect()
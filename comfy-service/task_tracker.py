@@ -0,0 +1,317 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import websockets
+
+import comfy_client
+import config as global_config
+from logger import app_logger as logger
+from metrics import COMFY_QUEUE_WAIT, WORKFLOW_DURATION
+from tracing import tracer
+from models import PromptResponse
+
+
+class TaskState:
+    """单个任务在本节点上的执行状态"""
+
+    def __init__(self, task_id: str, workflow: str = "", trace_id: Optional[str] = None):
+        self.task_id = task_id
+        self.workflow = workflow
+        self.trace_id = trace_id
+        self.status = "pending"  # pending, running, success, error
+        self.message = "Task has been uncompleted."
+        self.images: List[Dict[str, Any]] = []
+        # 按输出节点分组的图片，合并提交的任务据此拆分
+        self.outputs: Dict[str, List[Dict[str, Any]]] = {}
+        self.progress: Optional[Dict[str, Any]] = None
+        self.updated = time.time()
+        self.created = self.updated
+        self.started: Optional[float] = None
+        # 完成耗时只记录一次
+        self.observed = False
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("success", "error")
+
+    def to_response(self) -> PromptResponse:
+        return PromptResponse(status=self.status, message=self.message,
+                              images=self.images or None, progress=self.progress)
+
+
+class TaskTracker:
+    """
+        维持一条到 ComfyUI /ws 的长连接，消费执行事件并在内存中保存任务状态，
+        任务状态查询直接本地应答，不再轮询 /history
+    """
+
+    def __init__(self):
+        # ComfyUI 只把执行事件推送给提交 prompt 时的 client_id，所以本节点所有任务共用这一个
+        self.client_id = uuid.uuid4().hex
+        self.tasks: "OrderedDict[str, TaskState]" = OrderedDict()
+        # 任务事件订阅者，供 SSE 推送
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        # 合并提交: ComfyUI prompt_id -> [(任务 id, 图片数)]，以及任务 id -> prompt_id
+        self.batches: Dict[str, List[Tuple[str, int]]] = {}
+        self.parents: Dict[str, str] = {}
+        self.connected = False
+        # websocket 建立连接的次数，ComfyUI 重启后会重新连接，供依赖 ComfyUI 状态的缓存判断是否失效
+        self.connections = 0
+        # ComfyUI /queue 的短时缓存: prompt_id -> (状态, 位置)，以及队列总长
+        self.positions: Dict[str, Tuple[str, int]] = {}
+        self.queue_remaining = 0
+        self.positions_at = 0.0
+        self._positions_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def get(self, task_id: str) -> Optional[TaskState]:
+        return self.tasks.get(task_id)
+
+    def track(self, task_id: str, workflow: str = "", trace_id: Optional[str] = None) -> TaskState:
+        """登记任务，超出容量时淘汰最早的记录"""
+        state = self.tasks.get(task_id)
+        if state is None:
+            state = self.tasks[task_id] = TaskState(task_id, workflow, trace_id)
+            while len(self.tasks) > global_config.TASK_TRACKER_MAX_TASKS:
+                evicted, _ = self.tasks.popitem(last=False)
+                self.batches.pop(evicted, None)
+                self.parents.pop(evicted, None)
+        else:
+            # 执行事件可能先于 /prompt 的响应到达，此时没有 trace_id 的阶段补记到 trace 上
+            state.workflow = workflow or state.workflow
+            if trace_id and not state.trace_id:
+                state.trace_id = trace_id
+                if state.started:
+                    tracer.record(trace_id, "comfy.queue", state.created, state.started)
+                if state.observed:
+                    tracer.record(trace_id, "comfy.execute", state.started or state.created, state.updated,
+                                  status=state.status)
+        return state
+
+    def forget(self, task_id: str):
+        """撤销登记(提交失败的任务)，之后的重试不会被当作重复提交"""
+        self.tasks.pop(task_id, None)
+        self.parents.pop(task_id, None)
+
+    def track_batch(self, prompt_id: str, workflow: str, members: List[Tuple[str, int, Optional[str]]]):
+        """登记合并提交的 prompt 及其包含的任务 [(任务 id, 图片数, trace_id)]，按顺序拆分输出图片"""
+        parent = self.track(prompt_id, workflow)
+        for task_id, _, trace_id in members:
+            self.track(task_id, workflow, trace_id)
+            self.parents[task_id] = prompt_id
+        self.batches[prompt_id] = [(task_id, count) for task_id, count, _ in members]
+        # 执行事件可能先于登记到达
+        self.fan_out(parent)
+
+    def fan_out(self, parent: TaskState):
+        """
+            把合并 prompt 的状态同步给其中的任务，每个输出节点的图片按各任务的图片数依次切分
+            输出数量与批大小不符(工作流的输出不随 batch_size 增长)时无法拆分，所有任务置为失败
+        """
+        members = self.batches.get(parent.task_id)
+        if not members:
+            return
+        total = sum(count for _, count in members)
+        unsplittable = [f"node {node_id} produced {len(images)} images" for node_id, images in parent.outputs.items()
+                        if len(images) != total]
+        offset = 0
+        for task_id, count in members:
+            state = self.tasks.get(task_id)
+            if state is not None:
+                if parent.started and state.started is None:
+                    state.started = parent.started
+                    tracer.record(state.trace_id, "comfy.queue", state.created, parent.started)
+                state.status = parent.status
+                state.message = parent.message
+                state.progress = parent.progress
+                state.updated = parent.updated
+                state.images = []
+                if unsplittable:
+                    state.status = "error"
+                    state.message = f"coalesced outputs cannot be split for a batch of {total}: " \
+                                    + ", ".join(unsplittable)
+                else:
+                    for images in parent.outputs.values():
+                        state.images.extend(images[offset:offset + count])
+                self.observe(state)
+                self.notify(state)
+            offset += count
+
+    def handle(self, message: Dict[str, Any]):
+        """处理一条 ComfyUI 事件"""
+        event = message.get("type")
+        data = message.get("data") or {}
+        task_id = data.get("prompt_id")
+        if not task_id:
+            return
+        state = self.track(task_id)
+        state.updated = time.time()
+
+        if event == "execution_start":
+            state.status = "running"
+            state.started = state.updated
+            COMFY_QUEUE_WAIT.observe(state.updated - state.created, state.workflow)
+            tracer.record(state.trace_id, "comfy.queue", state.created, state.updated)
+        elif event == "executing":
+            if data.get("node") is None:
+                # node 为空表示整个 prompt 执行结束
+                self._finish(state)
+            else:
+                state.status = "running"
+        elif event == "progress":
+            state.status = "running"
+            state.progress = {"node": data.get("node"), "value": data.get("value"), "max": data.get("max")}
+        elif event == "executed":
+            images = (data.get("output") or {}).get("images")
+            if images:
+                state.images.extend(images)
+                state.outputs[str(data.get("node"))] = images
+        elif event == "execution_success":
+            self._finish(state)
+        elif event in ("execution_error", "execution_interrupted"):
+            state.status = "error"
+            state.message = data.get("exception_message") or "Task has been failed."
+        else:
+            return
+        self.observe(state)
+        self.notify(state)
+        self.fan_out(state)
+
+    def _finish(self, state: TaskState):
+        if state.status != "error":
+            state.status = "success"
+            state.message = "Task has been completed."
+
+    def observe(self, state: TaskState):
+        """任务结束时按工作流记录一次执行耗时，合并 prompt 本身不计，由其中的任务各记一次"""
+        if state.done and not state.observed and state.task_id not in self.batches:
+            state.observed = True
+            WORKFLOW_DURATION.observe(state.updated - state.created, state.workflow, state.status)
+            tracer.record(state.trace_id, "comfy.execute", state.started or state.created, state.updated,
+                          status=state.status)
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(task_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(task_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                self.subscribers.pop(task_id, None)
+
+    def notify(self, state: TaskState):
+        """把状态快照推给该任务的所有订阅者"""
+        queues = self.subscribers.get(state.task_id)
+        if queues:
+            snapshot = state.to_response().model_dump()
+            for queue in queues:
+                queue.put_nowait(snapshot)
+
+    @staticmethod
+    def apply_history(state: TaskState, result: Dict[str, Any]):
+        """用 /history 的结果补全任务状态"""
+        status = (result.get("status") or {}).get("status_str", "success")
+        images = []
+        state.outputs = {}
+        for node_id, output in result.get("outputs", {}).items():
+            if output.get("images"):
+                images.extend(output["images"])
+                state.outputs[node_id] = output["images"]
+        if status == "error":
+            state.status = "error"
+            state.message = "Task has been failed."
+        else:
+            state.status = "success"
+            state.message = "Task has been completed."
+        state.images = images
+        state.updated = time.time()
+
+    async def refresh(self, task_id: str) -> TaskState:
+        """从 /history 查询一次任务状态，websocket 不可用或任务未登记时使用"""
+        prompt_id = self.parents.get(task_id)
+        if prompt_id is not None:
+            # 合并提交的任务在 ComfyUI 中没有自己的记录，查询所属 prompt 后拆分
+            await self.refresh(prompt_id)
+            return self.track(task_id)
+        response = await comfy_client.get_client().get(f"/history/{task_id}")
+        response.raise_for_status()
+        res_json = response.json()
+        state = self.track(task_id)
+        if task_id in res_json:
+            self.apply_history(state, res_json[task_id])
+            self.observe(state)
+            self.notify(state)
+            self.fan_out(state)
+        return state
+
+    async def queue_position(self, task_id: str) -> Dict[str, Any]:
+        """
+            任务在 ComfyUI 队列中的实时位置: running 为 0，pending 为前面还有几个 prompt
+            /queue 会带上每个排队 prompt 的完整图，结果缓存 QUEUE_POSITION_TTL 秒，并发查询只请求一次
+        """
+        async with self._positions_lock:
+            if time.time() - self.positions_at > global_config.QUEUE_POSITION_TTL:
+                response = await comfy_client.get_client().get("/queue")
+                response.raise_for_status()
+                queue = response.json()
+                running = queue.get("queue_running") or []
+                # pending 是 ComfyUI 内部的堆，按提交序号排序才是执行顺序
+                pending = sorted(queue.get("queue_pending") or [], key=lambda item: item[0])
+                self.positions = {item[1]: ("running", 0) for item in running}
+                self.positions.update({item[1]: ("pending", len(running) + i) for i, item in enumerate(pending)})
+                self.queue_remaining = len(running) + len(pending)
+                self.positions_at = time.time()
+        # 合并提交的任务按所属 prompt 查询
+        state, position = self.positions.get(self.parents.get(task_id, task_id), ("unknown", None))
+        return {"task_id": task_id, "state": state, "position": position, "queue_remaining": self.queue_remaining}
+
+    async def reconcile(self):
+        """重连后补齐断线期间可能漏掉的完成事件"""
+        for task_id in [t for t, s in self.tasks.items() if not s.done and t not in self.parents]:
+            try:
+                await self.refresh(task_id)
+            except Exception as e:
+                logger.error(f"Error reconciling task {task_id}: {e}")
+
+    async def _run(self):
+        url = f"{global_config.COMFY_HOST.replace('http', 'ws', 1)}/ws?clientId={self.client_id}"
+        backoff = 1
+        while True:
+            try:
+                async with websockets.connect(url, max_size=None) as ws:
+                    self.connected = True
+                    self.connections += 1
+                    backoff = 1
+                    logger.info(f"ComfyUI websocket 已连接: {url}")
+                    await self.reconcile()
+                    async for raw in ws:
+                        # 二进制帧是预览图，忽略
+                        if isinstance(raw, str):
+                            self.handle(json.loads(raw))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"ComfyUI websocket error: {e}")
+            finally:
+                self.connected = False
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+task_tracker = TaskTracker()
@@ -0,0 +1,99 @@
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("loguru")
+
+from logger import TCPLoguruHandler
+
+
+class Listener:
+    """本地 logdy 替身: 接受连接并收集收到的日志"""
+
+    def __init__(self, port=0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        self.received = bytearray()
+        self.conns = []
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.conns.append(conn)
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def _read(self, conn):
+        while True:
+            try:
+                data = conn.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            self.received += data
+
+    def text(self):
+        return self.received.decode("utf-8")
+
+    def kill(self):
+        # 先 shutdown 唤醒阻塞在 accept 的线程，端口才能立刻重新绑定
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        for conn in self.conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+        self._thread.join(timeout=2)
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_reconnects_and_reports_dropped_lines():
+    listener = Listener()
+    handler = TCPLoguruHandler("127.0.0.1", listener.port, buffer_size=5, batch_size=2, flush_interval=0.05)
+    try:
+        handler.write("before\n")
+        assert wait_for(lambda: "before\n" in listener.text())
+
+        listener.kill()
+        # 对端关闭后第一次写可能仍然成功，持续写入直到发送线程发现断线
+        assert wait_for(lambda: handler.write("probe\n") or handler.sock is None)
+
+        # 断线期间写入超过缓冲区容量，最旧的日志被丢弃并计数
+        for i in range(20):
+            handler.write(f"line-{i}\n")
+        assert handler.dropped > 0
+
+        restarted = Listener(listener.port)
+        try:
+            assert wait_for(lambda: "line-19\n" in restarted.text())
+            text = restarted.text()
+            assert "logdy sender dropped" in text
+            assert "line-0\n" not in text
+            assert handler.dropped == 0
+        finally:
+            restarted.kill()
+    finally:
+        handler.stop()
@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+
+import config as global_config
+from task_tracker import TaskTracker
+
+
+async def serve(port, messages=()):
+    """本地 ComfyUI websocket 替身: 连接后依次推送 messages"""
+    async def handler(ws):
+        for message in messages:
+            await ws.send(json.dumps(message))
+        await ws.wait_closed()
+    return await websockets.serve(handler, "127.0.0.1", port)
+
+
+async def wait_for(predicate, timeout=10.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.02)
+    return False
+
+
+def test_reconnects_and_receives_events_after_restart(monkeypatch):
+    async def run():
+        server = await serve(0)
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(global_config, "COMFY_HOST", f"http://127.0.0.1:{port}")
+        tracker = TaskTracker()
+        await tracker.start()
+        try:
+            assert await wait_for(lambda: tracker.connected)
+            tracker.track("p1", "wf")
+
+            server.close()
+            await server.wait_closed()
+            assert await wait_for(lambda: not tracker.connected)
+
+            server = await serve(port, [{"type": "execution_success", "data": {"prompt_id": "p1"}}])
+            assert await wait_for(lambda: tracker.connections == 2)
+            assert await wait_for(lambda: tracker.get("p1").status == "success")
+        finally:
+            await tracker.stop()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import config as global_config
+from logger import app_logger as logger
+
+# 跨服务传递 trace id 的请求头
+TRACE_HEADER = "X-Trace-Id"
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+class Tracer:
+    """
+        本地 span 记录，不依赖外部采集器
+        最近的 trace 保存在内存中供 /debug/trace 查询，配置了 TRACE_FILE 时另外追加写入 JSONL 文件
+    """
+
+    def __init__(self, max_traces: int, path: str = ""):
+        self.max_traces = max_traces
+        self.path = path
+        self.traces: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._pending: List[str] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, trace_id: Optional[str], name: str, start: float, end: float, **attrs):
+        """记录一个阶段，start/end 为 time.time() 时间戳，便于跨主机对齐"""
+        if not trace_id:
+            return
+        span = {"name": name, "start": start, "end": end, "duration_ms": round((end - start) * 1000, 2)}
+        if attrs:
+            span["attrs"] = attrs
+        spans = self.traces.get(trace_id)
+        if spans is None:
+            spans = self.traces[trace_id] = []
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        spans.append(span)
+        if self.path:
+            self._pending.append(json.dumps({"trace_id": trace_id, **span}))
+
+    @contextmanager
+    def span(self, trace_id: Optional[str], name: str, **attrs) -> Iterator[Dict[str, Any]]:
+        """计时一个阶段，可在块内向返回的字典补充属性"""
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            self.record(trace_id, name, start, time.time(), **attrs)
+
+    def get(self, trace_id: str) -> List[Dict[str, Any]]:
+        return list(self.traces.get(trace_id, ()))
+
+    def _append(self, lines: List[str]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    async def _flush(self):
+        while True:
+            await asyncio.sleep(1)
+            if not self._pending:
+                continue
+            lines, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._append, lines)
+            except Exception as e:
+                logger.error(f"Error exporting spans: {e}")
+
+    async def start(self):
+        if self.path:
+            self._task = asyncio.create_task(self._flush())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._pending:
+            lines, self._pending = self._pending, []
+            await asyncio.to_thread(self._append, lines)
+
+
+tracer = Tracer(global_config.TRACE_MAX_TRACES, global_config.TRACE_FILE)
@@ -0,0 +1,238 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+import config as global_config
+import paths
+from logger import app_logger as logger
+
+
+INPUT_TYPES = {"str": str, "int": int, "float": (int, float), "bool": bool}
+
+# 模型文件扩展名，用于从 Loader 节点的输入中识别模型
+MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".sft")
+
+
+def graph_models(graph: Dict[str, Any]) -> List[str]:
+    """prompt 图中 Loader 类节点引用的模型文件(checkpoint、LoRA、VAE 等)，去重后排序"""
+    models = set()
+    for node in graph.values():
+        if "Loader" not in node.get("class_type", ""):
+            continue
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, str) and value.lower().endswith(MODEL_EXTENSIONS):
+                models.add(value)
+    return sorted(models)
+
+
+class WorkflowLoadError(Exception):
+    """工作流文件或参数声明不合法，属于部署错误而不是请求错误"""
+
+
+class WorkflowEntry:
+    """已解析的工作流: API 图 + 预序列化好的 extra_pnginfo"""
+
+    def __init__(self, name: str, mtimes: Tuple[int, ...], workflow: Dict[str, Any],
+                 api_graph: Optional[Dict[str, Any]], inputs: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.name = name
+        self.mtimes = mtimes
+        self.workflow_bytes = orjson.dumps(workflow)
+        self.api_graph = api_graph
+        self.api_bytes = orjson.dumps(api_graph) if api_graph is not None else None
+        # 每个节点单独序列化成 "id":{...} 片段，参数覆盖时只重新序列化被修改的节点
+        self.node_parts = {node_id: orjson.dumps(node_id) + b":" + orjson.dumps(node)
+                           for node_id, node in (api_graph or {}).items()}
+        self.inputs = inputs or {}
+        # 提交时原样拼接进请求体，大体积的 UI 工作流不再重复序列化
+        self.extra_data_bytes = b'{"extra_pnginfo":{"workflow":' + self.workflow_bytes + b'}}'
+        self.models = graph_models(api_graph or {})
+        self._check_inputs()
+        self.model_spec = self._model_spec()
+
+    def _check_inputs(self):
+        """加载时校验参数声明指向的节点和输入确实存在"""
+        for key, spec in self.inputs.items():
+            node = (self.api_graph or {}).get(spec.get("node"))
+            if node is None or spec.get("input") not in node.get("inputs", {}):
+                raise ValueError(f"workflow {self.name} input '{key}' points to missing {spec}")
+
+    def _model_spec(self) -> Dict[str, Any]:
+        """
+            发布给 balancer 的模型描述，balancer 不再自行解析 Loader 节点:
+            fixed 为参数无法覆盖的模型，inputs 为指向 Loader 模型输入的参数及其默认值
+        """
+        overridable = {(spec["node"], spec["input"]): key for key, spec in self.inputs.items()}
+        fixed, inputs = set(), {}
+        for node_id, node in (self.api_graph or {}).items():
+            if "Loader" not in node.get("class_type", ""):
+                continue
+            for name, value in node.get("inputs", {}).items():
+                if not isinstance(value, str) or not value.lower().endswith(MODEL_EXTENSIONS):
+                    continue
+                key = overridable.get((node_id, name))
+                if key is None:
+                    fixed.add(value)
+                else:
+                    inputs[key] = value
+        return {"fixed": sorted(fixed), "inputs": inputs}
+
+    def patch(self, values: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """
+            按参数声明生成被修改的节点，未修改的节点与缓存共享，不做整图深拷贝
+            返回 {node_id: 新节点}
+        """
+        patched: Dict[str, Dict[str, Any]] = {}
+        for key, value in values.items():
+            spec = self.inputs.get(key)
+            if spec is None:
+                raise ValueError(f"unknown input '{key}' for workflow {self.name}, available: {list(self.inputs)}")
+            expected = INPUT_TYPES.get(spec.get("type"))
+            if expected is not None and (not isinstance(value, expected) or
+                                         (spec.get("type") != "bool" and isinstance(value, bool))):
+                raise ValueError(f"input '{key}' expects {spec['type']}")
+            node_id = spec["node"]
+            node = patched.get(node_id)
+            if node is None:
+                base = self.api_graph[node_id]
+                node = patched[node_id] = {**base, "inputs": dict(base["inputs"])}
+            node["inputs"][spec["input"]] = value
+        return patched
+
+    def models_for(self, patched: Dict[str, Dict[str, Any]]) -> List[str]:
+        """本次提交用到的模型，只有参数覆盖了 Loader 节点时才重新提取"""
+        if any("Loader" in node.get("class_type", "") for node in patched.values()):
+            return graph_models(self.resolve(patched))
+        return self.models
+
+    def resolve(self, patched: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """得到完整的 prompt 图(浅层合并，未修改节点仍指向缓存对象，只读使用)"""
+        if not patched:
+            return self.api_graph
+        return {**self.api_graph, **patched}
+
+    def render(self, patched: Dict[str, Dict[str, Any]]) -> bytes:
+        """序列化 prompt 图，只有被修改的节点需要重新序列化"""
+        if not patched:
+            return self.api_bytes
+        parts = [
+            orjson.dumps(node_id) + b":" + orjson.dumps(patched[node_id]) if node_id in patched else part
+            for node_id, part in self.node_parts.items()
+        ]
+        return b"{" + b",".join(parts) + b"}"
+
+
+def build_prompt_body(client_id: str, prompt_bytes: bytes, extra_data_bytes: bytes, prompt_id: str = None,
+                      trace_id: str = None) -> bytes:
+    """
+        拼接 /prompt 请求体，各部分均为已序列化的 JSON；prompt_id 为空时由 ComfyUI 生成
+        trace_id 写入 extra_data，ComfyUI 会原样保存在 history 中
+    """
+    if trace_id:
+        extra_data_bytes = extra_data_bytes[:-1] + b',"trace_id":' + orjson.dumps(trace_id) + b'}'
+    body = (b'{"client_id":' + orjson.dumps(client_id)
+            + b',"prompt":' + prompt_bytes
+            + b',"extra_data":' + extra_data_bytes)
+    if prompt_id:
+        body += b',"prompt_id":' + orjson.dumps(prompt_id)
+    return body + b'}'
+
+
+
+class WorkflowRegistry:
+    """
+        工作流缓存
+        每个工作流只读取、解析一次，按 LRU 限制数量，后台轮询 mtime 发现文件变更后失效
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, WorkflowEntry]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _paths(name: str) -> Tuple[str, str, str]:
+        return (paths.get_workflow_path(name + ".json"),
+                paths.get_workflow_path(name + "-api.json"),
+                paths.get_workflow_path(name + "-inputs.json"))
+
+    def _mtimes(self, name: str) -> Optional[Tuple[int, ...]]:
+        """工作流、API、参数声明三个文件的 mtime，UI 工作流不存在时返回 None"""
+        mtimes = []
+        for path in self._paths(name):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(0)
+        if not mtimes[0]:
+            return None
+        return tuple(mtimes)
+
+    def _load(self, name: str) -> Optional[WorkflowEntry]:
+        mtimes = self._mtimes(name)
+        if mtimes is None:
+            return None
+        workflow_path, api_path, inputs_path = self._paths(name)
+        workflow_content = paths.load_content(workflow_path)
+        if workflow_content is None:
+            return None
+        api_content = paths.load_content(api_path) if mtimes[1] else None
+        api_graph = orjson.loads(api_content) if api_content is not None else None
+        inputs_content = paths.load_content(inputs_path) if mtimes[2] else None
+        inputs = orjson.loads(inputs_content) if inputs_content is not None else None
+        logger.info(f"加载工作流: {name}")
+        return WorkflowEntry(name, mtimes, orjson.loads(workflow_content), api_graph, inputs)
+
+    def _load_checked(self, name: str) -> Optional[WorkflowEntry]:
+        try:
+            return self._load(name)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # JSON 解析失败、参数声明指向不存在的节点等
+            logger.error(f"工作流 {name} 不合法: {e}")
+            raise WorkflowLoadError(f"workflow {name} is invalid: {e}") from e
+
+    async def get(self, name: str) -> Optional[WorkflowEntry]:
+        """获取工作流，不存在时返回 None，文件不合法时抛出 WorkflowLoadError"""
+        entry = self.entries.get(name)
+        if entry is not None:
+            self.entries.move_to_end(name)
+            return entry
+        entry = await asyncio.to_thread(self._load_checked, name)
+        if entry is not None:
+            self.entries[name] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, name: str = None):
+        if name is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(name, None)
+
+    def _changed(self) -> list:
+        return [name for name, entry in list(self.entries.items()) if self._mtimes(name) != entry.mtimes]
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(global_config.WORKFLOW_WATCH_INTERVAL)
+            try:
+                for name in await asyncio.to_thread(self._changed):
+                    logger.info(f"工作流文件已变更，缓存失效: {name}")
+                    self.invalidate(name)
+            except Exception as e:
+                logger.error(f"Error watching workflow dir: {e}")
+
+    async def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+workflow_registry = WorkflowRegistry(global_config.WORKFLOW_CACHE_SIZE)